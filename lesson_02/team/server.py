@@ -19,8 +19,8 @@ Top level url returns the following
 """
 
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from socketserver import ThreadingMixIn
 import threading
+import queue
 import time
 import json
 import os
@@ -36,6 +36,12 @@ URL_STARSHIPS = "starships"
 
 DELAY = 0.5         # Delay
 
+# Fixed size pool of server threads and the number of connections that can
+# wait for one.  Anything beyond that gets a 503 busy reply.  The pool is
+# larger than the team solutions' biggest burst (92 calls for film 6).
+POOL_WORKERS = 128
+POOL_BACKLOG = 512
+
 master_dict = {}
 
 class Handler(BaseHTTPRequestHandler):
@@ -99,8 +105,79 @@ class Handler(BaseHTTPRequestHandler):
                             self.wfile.write(str.encode(js))
 
 
-class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    pass
+class ThreadPoolServer(HTTPServer):
+    """ HTTP server that handles connections with a fixed pool of threads.
+        Accepted connections wait in a bounded queue.  When the queue is full
+        the client is sent a 503 "busy" reply instead, and a separate thread
+        reads the request and closes the connection. """
+
+    def __init__(self, server_address, handler, workers=POOL_WORKERS, backlog=POOL_BACKLOG):
+        self.request_queue_size = backlog
+        self.connections = queue.Queue(maxsize=backlog)
+        self.workers = []
+        self.rejected = queue.SimpleQueue()
+        super().__init__(server_address, handler)
+        for _ in range(workers):
+            t = threading.Thread(target=self.worker, daemon=True)
+            t.start()
+            self.workers.append(t)
+        threading.Thread(target=self.rejecter, daemon=True).start()
+
+    def worker(self):
+        while True:
+            item = self.connections.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        try:
+            self.connections.put_nowait((request, client_address))
+        except queue.Full:
+            self.send_busy(request)
+
+    def send_busy(self, request):
+        body = b'{"status":"BUSY"}'
+        reply = b'HTTP/1.0 503 Service Unavailable\r\n' + \
+                b'Content-type: application/json\r\n' + \
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\n' + \
+                b'Retry-After: 1\r\n' + \
+                b'Connection: close\r\n\r\n' + body
+        try:
+            # called from the accept loop: never wait on the client here, the
+            # reply fits in the empty send buffer of a new connection
+            request.setblocking(False)
+            request.send(reply)
+        except OSError:
+            pass
+        self.rejected.put(request)
+
+    def rejecter(self):
+        # Reads the request of each rejected connection before closing it:
+        # closing a socket with unread data resets the connection and the
+        # client may never see the 503
+        while True:
+            request = self.rejected.get()
+            if request is None:
+                break
+            try:
+                request.settimeout(0.1)
+                request.recv(65536)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self.workers:
+            self.connections.put(None)
+        self.rejected.put(None)
 
 
 def run():
@@ -123,7 +200,7 @@ def run():
 
     print(f'Star Wars server waiting..... \nURL: {TOP_API_URL}')
 
-    server = ThreadingSimpleServer(('localhost', 8790), Handler)
+    server = ThreadPoolServer(('localhost', 8790), Handler)
     server.serve_forever()
 
 
@@ -11,23 +11,33 @@ In order to retrieve a weather record from the server, use the URL:
 where:
     name: name of the city
     recno: record number starting from 0
+
+Records are retrieved RANGE_SIZE at a time with:
+    f"{TOP_API_URL}/records/{name}?start={recno}&count={RANGE_SIZE}"
+which returns them as [date, temp] pairs for one round trip.
 """
 
 import threading
 import queue
+import numpy as np
 from common import *
 from cse351 import Log
 
 
-THREADS = 200               
+THREADS = 100               # at most one range call per thread
 WORKERS = 10                
 RECORDS_TO_RETRIEVE = 5000  # Don't change
+RANGE_SIZE = 500            # records per call
+PERCENTILES = (5, 50, 95)
+
+# days before the first of each month, for record timestamps
+DAYS_BEFORE_MONTH = (0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)
 
 
 def retrieve_weather_data(task_q, result_q):
     """
-    Fetch threads: pull (city, recno) from task_q, call server,
-    then push (city, date, temp) into result_q. Stops on None sentinel.
+    Fetch threads: pull (city, start, count) from task_q, call server,
+    then push (city, start, records) into result_q. Stops on None sentinel.
     """
     while True:
         task = task_q.get()
@@ -35,47 +45,106 @@ def retrieve_weather_data(task_q, result_q):
             # Notify queue and exit
             task_q.task_done()
             break
-        city, recno = task
-        data = get_data_from_server(f"{TOP_API_URL}/record/{city}/{recno}")
+        city, start, count = task
+        data = get_data_from_server(f"{TOP_API_URL}/records/{city}?start={start}&count={count}")
         if data:
-            result_q.put((data['city'], data['date'], data['temp']))
+            result_q.put((data['city'], start, data['records']))
         task_q.task_done()
 
 
 class Worker(threading.Thread):
+    """
+    Worker threads: store each range of records in the NOAA arrays and keep
+    their own sum and count per city, with no lock.  The sums are merged into
+    the NOAA totals once, when the worker stops.
+    """
     def __init__(self, result_q, noaa):
         super().__init__()
         self.result_q = result_q
         self.noaa = noaa
+        self.sums = [0.0] * len(CITIES)
+        self.counts = [0] * len(CITIES)
         self.start()
 
     def run(self):
         while True:
             item = self.result_q.get()
             if item is None:
+                self.noaa.merge(self.sums, self.counts)
                 self.result_q.task_done()
                 break
-            city, date, temp = item
-            self.noaa.add_record(city, date, temp)
+            city, start, records = item
+            row = self.noaa.add_records(city, start, records)
+            self.sums[row] += sum(temp for _, temp in records)
+            self.counts[row] += len(records)
             self.result_q.task_done()
 
 
+def date_to_seconds(date):
+    # "mm-dd hh:mm:ss" -> seconds since Jan 1 00:00:00
+    days = DAYS_BEFORE_MONTH[int(date[0:2]) - 1] + int(date[3:5]) - 1
+    return ((days * 24 + int(date[6:8])) * 60 + int(date[9:11])) * 60 + int(date[12:14])
+
+
 class NOAA:
-    def __init__(self):
+    """
+    Records are kept in preallocated arrays, one row per city and one column
+    per record number.  Each record has its own slot, so storing records
+    needs no lock.  get_stats() works out every city's statistics with numpy
+    in one pass at the end.
+    """
+    def __init__(self, records=RECORDS_TO_RETRIEVE):
+        self.rows = {name: row for row, name in enumerate(CITIES)}
+        self.temps = np.full((len(CITIES), records), np.nan)
+        self.times = np.zeros((len(CITIES), records), dtype=np.int64)
+        # merged worker sums, the lock is only taken once per worker
         self.lock = threading.Lock()
-        # sum and count for each city
-        self.totals = {name: {'sum': 0.0, 'count': 0} for name in CITIES}
-
-    def add_record(self, city, date, temp):
+        self.totals = np.zeros(len(CITIES))
+        self.counts = np.zeros(len(CITIES), dtype=np.int64)
+        self.stats = None
+
+    def add_records(self, city, start, records):
+        # [date, temp] pairs for record numbers start, start + 1, ...
+        # returns the city's row for the caller's own sums
+        row = self.rows[city]
+        end = start + len(records)
+        self.temps[row, start:end] = [temp for _, temp in records]
+        self.times[row, start:end] = [date_to_seconds(date) for date, _ in records]
+        return row
+
+    def merge(self, sums, counts):
         with self.lock:
-            self.totals[city]['sum'] += temp
-            self.totals[city]['count'] += 1
+            self.totals += sums
+            self.counts += counts
+            self.stats = None
 
     def get_temp_details(self, city):
-        with self.lock:
-            total = self.totals[city]['sum']
-            count = self.totals[city]['count']
-        return (total / count) if count > 0 else 0.0
+        row = self.rows[city]
+        count = self.counts[row]
+        return float(self.totals[row] / count) if count > 0 else 0.0
+
+    def get_stats(self):
+        # city -> count, mean, min, max, std and the PERCENTILES of its records
+        if self.stats is None:
+            temps = self.temps
+            counts = np.count_nonzero(~np.isnan(temps), axis=1)
+            with np.errstate(invalid='ignore'):
+                means = np.nanmean(temps, axis=1)
+                mins = np.nanmin(temps, axis=1)
+                maxs = np.nanmax(temps, axis=1)
+                stds = np.nanstd(temps, axis=1)
+                pcts = np.nanpercentile(temps, PERCENTILES, axis=1)
+            self.stats = {}
+            for name, row in self.rows.items():
+                self.stats[name] = {
+                    'count': int(counts[row]),
+                    'mean': float(means[row]),
+                    'min': float(mins[row]),
+                    'max': float(maxs[row]),
+                    'std': float(stds[row]),
+                    **{f'p{pct}': float(pcts[i][row]) for i, pct in enumerate(PERCENTILES)},
+                }
+        return self.stats
 
 
 def verify_noaa_results(noaa):
@@ -101,6 +170,17 @@ def verify_noaa_results(noaa):
     print('===================================')
 
 
+def print_noaa_stats(noaa):
+    stats = noaa.get_stats()
+    pct_titles = ''.join(f'{"p" + str(pct):>8}' for pct in PERCENTILES)
+    print()
+    print(f'{"City":>15}: {"count":>6}{"mean":>9}{"min":>8}{"max":>8}{"std":>8}{pct_titles}')
+    for name in CITIES:
+        city = stats[name]
+        pcts = ''.join(f'{city["p" + str(pct)]:>8.2f}' for pct in PERCENTILES)
+        print(f'{name:>15}: {city["count"]:>6}{city["mean"]:>9.4f}{city["min"]:>8.2f}{city["max"]:>8.2f}{city["std"]:>8.3f}{pcts}')
+
+
 def main():
     log = Log(show_terminal=True, filename_log='assignment.log')
     log.start_timer()
@@ -135,10 +215,10 @@ def main():
         t.start()
         fetchers.append(t)
 
-    # Enqueue all fetch tasks
+    # Enqueue all fetch tasks, one per range of records
     for city in CITIES:
-        for recno in range(RECORDS_TO_RETRIEVE):
-            task_q.put((city, recno))
+        for start in range(0, RECORDS_TO_RETRIEVE, RANGE_SIZE):
+            task_q.put((city, start, min(RANGE_SIZE, RECORDS_TO_RETRIEVE - start)))
 
     # Send sentinel None to fetch threads
     for _ in range(THREADS):
@@ -162,6 +242,7 @@ def main():
 
     # Verify correctness
     verify_noaa_results(noaa)
+    print_noaa_stats(noaa)
 
     log.stop_timer('Run time: ')
 
@@ -12,6 +12,7 @@ Common data for the assignment
 """
 
 import time
+import random
 import threading
 import json
 import requests
@@ -33,28 +34,97 @@ CITIES = (
     'phoenix',
 )
 
+# Retry policy for get_data_from_server().  Failed calls are retried with
+# exponential backoff and jitter so that threads that failed together don't
+# all retry together.  A call gives up after RETRIES attempts or after
+# RETRY_DEADLINE seconds, whichever comes first.
+RETRIES = 50
+RETRY_BASE_DELAY = 0.01     # seconds, doubles with each attempt
+RETRY_MAX_DELAY = 2.0       # seconds
+RETRY_DEADLINE = 60         # seconds for a call including all of its retries
+REQUEST_TIMEOUT = 10        # seconds for one attempt
+RETRY_STATUS = (500, 502, 503, 504)
+
+# Retries are also limited across all threads: each retry takes a token from
+# a shared budget that refills at RETRY_RATE tokens per second.  When many
+# threads fail at once their retries are spread out at that rate instead of
+# all hitting the server again at the same moment.
+RETRY_BUDGET = 50
+RETRY_RATE = 20             # retries per second for all threads together
+
+# ----------------------------------------------------------------------------
+class RetryBudget:
+
+    def __init__(self, size=RETRY_BUDGET, rate=RETRY_RATE):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.size = size
+        self.rate = rate
+        self.tokens = size
+        self.updated = time.monotonic()
+
+    def reserve(self, deadline):
+        # Takes a token and returns how long to wait before it can be used,
+        # None (and no token taken) if that is past the deadline
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.size, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(0, (1 - self.tokens) / self.rate)
+            if now + wait > deadline:
+                return None
+            self.tokens -= 1
+            return wait
+
+retry_budget = RetryBudget()
+
+def retry_delay(attempt, retry_after=0):
+    # "full jitter" backoff, never less than the server's Retry-After
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    return max(delay, retry_after)
+
+def get_retry_after(value):
+    # seconds from a Retry-After header, 0 if there isn't one
+    try:
+        return float(value or 0)
+    except ValueError:
+        return 0
+
+def get_retry_wait(attempt, delay, deadline):
+    # seconds to wait before the next attempt, None to give up
+    if attempt < RETRIES - 1 and time.monotonic() + delay <= deadline:
+        wait = retry_budget.reserve(deadline - delay)
+        if wait is not None:
+            return max(delay, wait)
+    print("Max retries reached. Failing.")
+    return None
+
 # ----------------------------------------------------------------------------
 def get_data_from_server(url):
-    retries = 50
-    delay = 0.01 # seconds
-    for i in range(retries):
+    deadline = time.monotonic() + RETRY_DEADLINE
+    for attempt in range(RETRIES):
+        retry_after = 0
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            if response.status_code == 200 and response.json() is not None:
-                return response.json()
-            break
-
-        except requests.exceptions.ConnectionError as e:
-            if i < retries - 1:
-                time.sleep(delay)
+            timeout = min(REQUEST_TIMEOUT, max(deadline - time.monotonic(), 0.1))
+            response = requests.get(url, timeout=timeout)
+            if response.status_code in RETRY_STATUS:
+                # server error or 503 busy, try again after a backoff
+                retry_after = get_retry_after(response.headers.get('Retry-After'))
             else:
-                print("Max retries reached. Failing.")
-                
-        except requests.exceptions.Timeout:
-            ...
+                response.raise_for_status()
+                if response.status_code == 200 and response.json() is not None:
+                    return response.json()
+                break
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            pass
             
         except requests.exceptions.RequestException as e:
             break
 
+        delay = get_retry_wait(attempt, retry_delay(attempt, retry_after), deadline)
+        if delay is None:
+            break
+        time.sleep(delay)
+
     return None
\ No newline at end of file
@@ -27,17 +27,23 @@ API
 /end
 /city/{city}
 /record/{city}/{recno}`
+/records/{city}?start={recno}&count={n}   n records in one call
 
 """
 
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from socketserver import ThreadingMixIn
 import datetime
 import json
 import time
 import random
 import threading
+import bisect
+import math
+import atexit
+import queue
 import ast
+from collections import deque
+from urllib.parse import urlparse, parse_qs
 
 # Consts
 hostName = "127.0.0.1"
@@ -45,6 +51,25 @@ serverPort = 8123
 
 SLEEP = 0.1
 MAX_GENERATIONS = 6
+MAX_RANGE = 5000            # most records one /records call returns
+
+# Fixed size pool of server threads and the number of connections that can
+# wait for one.  Anything beyond that gets a 503 busy reply.
+POOL_WORKERS = 200
+POOL_BACKLOG = 1000
+
+# Log levels and settings for the server log
+DEBUG = 10          # every request and reply
+INFO = 20           # tree / session summaries
+LOG_LEVEL = DEBUG
+LOG_FLUSH_INTERVAL = 0.5    # seconds
+LOG_PAYLOADS = True         # False logs the size of each reply, not the JSON
+
+# /metrics latency histogram bucket upper bounds (seconds) and how many recent
+# requests per route are kept for the percentiles
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+METRICS_SAMPLES = 10000
+ROUTES = ('start', 'end', 'city', 'record', 'records')
 
 DATA_FOLDER = 'data/'
 
@@ -76,28 +101,187 @@ end_time = time.time()
 
 # ----------------------------------------------------------------------------
 class Log:
+    """ Buffered log file.  write() only queues the line, a background thread
+        writes whatever has been queued in one batch and flushes the file at
+        most every flush_interval seconds.  Lines below level are dropped.
+        With payloads=False, write_payload() logs the size of a reply instead
+        of the reply itself. """
 
-    def __init__(self, filename):
+    def __init__(self, filename, level=LOG_LEVEL, flush_interval=LOG_FLUSH_INTERVAL, payloads=LOG_PAYLOADS):
         super().__init__()
-        self.lock = threading.Lock()
         self.filename = filename
+        self.level = level
+        self.flush_interval = flush_interval
+        self.payloads = payloads
+        self.lines = queue.SimpleQueue()
+        self.closed = False
         self.file = open(filename, 'w')
+        self.writer = threading.Thread(target=self._write_lines, daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def write(self, line, level=INFO, show=False):
+        # show=True also prints the line on the terminal from the writer
+        # thread, so request threads never wait on the console
+        if level >= self.level:
+            self.lines.put((line, show))
+
+    def write_payload(self, label, payload, level=DEBUG, show=False):
+        if self.payloads:
+            self.write(f'{label}: {payload}', level, show)
+        else:
+            self.write(f'{label}: {len(payload)} bytes', level, show)
 
-    def write(self, line):
-        with self.lock:
-            self.file.write(line)
-            self.file.write('\n')
-            self.file.flush()
+    def _write_lines(self):
+        last_flush = time.time()
+        while True:
+            try:
+                batch = [self.lines.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                self.file.flush()
+                last_flush = time.time()
+                continue
+
+            while True:
+                try:
+                    batch.append(self.lines.get_nowait())
+                except queue.Empty:
+                    break
+
+            closing = None in batch
+            if closing:
+                batch = batch[:batch.index(None)]
+
+            if batch:
+                self.file.write('\n'.join(line for line, _ in batch) + '\n')
+                shown = [line for line, show in batch if show]
+                if shown:
+                    print('\n'.join(shown))
+
+            if closing or time.time() - last_flush >= self.flush_interval:
+                self.file.flush()
+                last_flush = time.time()
+
+            if closing:
+                self.file.close()
+                return
 
-    def __del__(self):
-        self.file.close()
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.lines.put(None)
+            self.writer.join()
 
 # Global log object
 log = Log('server.log')
 
+# ----------------------------------------------------------------------------
+class Metrics:
+    """ Per route request counts, bytes sent, 404s and latency for /metrics.
+        Latency is kept both as histogram buckets and as the most recent
+        METRICS_SAMPLES requests, which the p50 / p95 / p99 come from. """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.reset()
+
+    def reset(self):
+        # requests already in flight are still counted when they finish
+        with self.lock:
+            self.started = time.time()
+            self.routes = {}
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+        return time.perf_counter()
+
+    def finish(self, route, started, status, sent):
+        latency = time.perf_counter() - started
+        with self.lock:
+            self.in_flight -= 1
+            stats = self.routes.get(route)
+            if stats == None:
+                stats = {
+                    'requests': 0,
+                    'not_found': 0,
+                    'bytes_sent': 0,
+                    'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+                    'samples': deque(maxlen=METRICS_SAMPLES),
+                }
+                self.routes[route] = stats
+            stats['requests'] += 1
+            if status == 404:
+                stats['not_found'] += 1
+            stats['bytes_sent'] += sent
+            stats['buckets'][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            stats['samples'].append(latency)
+
+    def get_dict(self):
+        with self.lock:
+            routes = {}
+            for route, stats in self.routes.items():
+                samples = sorted(stats['samples'])
+                # cumulative like a Prometheus histogram: requests <= bound
+                buckets = {}
+                total = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('inf',), stats['buckets']):
+                    total += count
+                    buckets[f'le_{bound}'] = total
+                routes[route] = {
+                    'requests': stats['requests'],
+                    'not_found': stats['not_found'],
+                    'bytes_sent': stats['bytes_sent'],
+                    'p50': percentile(samples, 50),
+                    'p95': percentile(samples, 95),
+                    'p99': percentile(samples, 99),
+                    'histogram': buckets,
+                }
+            return {
+                'uptime': time.time() - self.started,
+                'in_flight': self.in_flight,
+                'requests': sum(r['requests'] for r in routes.values()),
+                'not_found': sum(r['not_found'] for r in routes.values()),
+                'bytes_sent': sum(r['bytes_sent'] for r in routes.values()),
+                'routes': routes,
+            }
+
+def percentile(samples, pct):
+    # nearest rank percentile of a sorted list
+    if not samples:
+        return None
+    index = max(math.ceil(pct / 100 * len(samples)) - 1, 0)
+    return samples[index]
+
+def expand_date(date_str):
+    # Expand date string to "mm-dd hh:mm:ss"
+    #         01234567890
+    # format "mmdd hhmmss"
+    return date_str[:2] + '-' + date_str[2:4] + ' ' + date_str[5:7] + ':' + date_str[7:9] + ':' + date_str[9:]
+
+def route_name(path):
+    # first part of the path: /person/123 -> "person"
+    name = urlparse(path).path.strip('/').split('/')[0]
+    if name == '':
+        return 'top'
+    return name if name in ROUTES else 'other'
+
+# Global metrics object
+metrics = Metrics()
+
 # ----------------------------------------------------------------------------
 class Handler(BaseHTTPRequestHandler):
 
+    def log_message(self, format, *args):
+        # access log lines go through the buffered log instead of stderr
+        log.write(f'{self.address_string()} - {format % args}', DEBUG)
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
+
     def get_city_details(self, name):
         # global people
         # if id in people:
@@ -115,30 +299,78 @@ class Handler(BaseHTTPRequestHandler):
         #     return None
         pass
 
-   
+
     def do_GET(self):
+        self.status_code = None
+        self.bytes_sent = 0
+
+        if urlparse(self.path).path == '/metrics':
+            # can be read at any time, not counted as an API call
+            body = bytes(json.dumps(metrics.get_dict()), "utf8")
+            self.send_response(200)
+            self.send_header("Content-type",  "application/json")
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        started = metrics.start()
+        try:
+            self.handle_get()
+        finally:
+            metrics.finish(route_name(self.path), started, self.status_code, self.bytes_sent)
+   
+    def handle_get(self):
         global thread_count
         global lock
         global max_thread_count
         global call_count
         global log
+        global cities_data
 
         with lock:
             thread_count += 1
             call_count += 1
             if thread_count > max_thread_count:
                 max_thread_count = thread_count
-            print(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
-            log.write(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
+            log.write(f'Current: active threads / max count: {thread_count} / {max_thread_count}', DEBUG, show=True)
+
+        log.write('- ' * 35, DEBUG, show=True)
+        log.write(f'Request: {self.path}', DEBUG, show=True)
+
+        # CITY RECORD RANGE  ---------------------------------------------
+        # before START: "?start=" is in the path too.  One SLEEP for the
+        # whole range, the records are [date, temp] pairs.
+        if self.path.startswith('/records/'):
+
+            if SLEEP > 0:
+                time.sleep(SLEEP)
 
-        print('- ' * 35)
-        print(s := f'Request: {self.path}')
-        log.write(s)
+            url = urlparse(self.path)
+            parts = url.path.split('/')
+            query = parse_qs(url.query)
+            try:
+                name = parts[2].lower()
+                start = int(query.get('start', ['0'])[0])
+                count = int(query.get('count', [str(MAX_RANGE)])[0])
+            except:
+                name = None
+
+            if len(parts) != 3 or name not in cities_data or start < 0 or count < 1:
+                self.send_response(404)
+                self.send_header("Content-type",  "application/json")
+                self.end_headers()
+                with lock:
+                    thread_count -= 1
+                return
+
+            rows = cities_data[name][start:start + min(count, MAX_RANGE)]
+            records = [[expand_date(date_str), temp] for date_str, temp in rows]
+            json_data = json.dumps({'status': 'OK', 'city': name, 'start': start, 'records': records},
+                                   separators=(',', ':'))
 
         # START ---------------------------------------------------
-        if 'start' in self.path:
+        elif 'start' in self.path:
             global start_time
-            global cities_data
 
             # Load DAT files
             cities_data = {}
@@ -153,6 +385,7 @@ class Handler(BaseHTTPRequestHandler):
             call_count = 1
 
             start_time = time.time()
+            metrics.reset()
 
             json_data = '{"status":"OK"}'
 
@@ -269,11 +502,7 @@ class Handler(BaseHTTPRequestHandler):
 
             date_str = cities_data[name][record][0]         # Format "mmdd hhmmss"
             temp = cities_data[name][record][1]
-
-            # Expand date string to "mm-dd hh:mm:ss"
-            #         01234567890
-            # format "mmdd hhmmss"
-            date_str = date_str[:2] + '-' + date_str[2:4] + ' ' + date_str[5:7] + ':' + date_str[7:9] + ':' + date_str[9:]
+            date_str = expand_date(date_str)
 
             data_str = '{' + \
                        f'"status":"OK", "city": "{name}", "date": "{date_str}", "temp": {temp}' + \
@@ -289,24 +518,96 @@ class Handler(BaseHTTPRequestHandler):
             self.send_header("Content-type",  "application/json")
             self.end_headers()
         else:
-            print('Sending:', json_data)
-            log.write(f'Sending: {json_data}')
+            log.write_payload('Sending', json_data, show=True)
 
             self.send_response(200)
             self.send_header("Content-type",  "application/json")
             self.end_headers()
-            self.wfile.write(bytes(json_data, "utf8"))
+            body = bytes(json_data, "utf8")
+            self.bytes_sent = len(body)
+            self.wfile.write(body)
 
         with lock:
             thread_count -= 1
 
 
-class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    pass
+class ThreadPoolServer(HTTPServer):
+    """ HTTP server that handles connections with a fixed pool of threads.
+        Accepted connections wait in a bounded queue.  When the queue is full
+        the client is sent a 503 "busy" reply instead, and a separate thread
+        reads the request and closes the connection. """
+
+    def __init__(self, server_address, handler, workers=POOL_WORKERS, backlog=POOL_BACKLOG):
+        self.request_queue_size = backlog
+        self.connections = queue.Queue(maxsize=backlog)
+        self.workers = []
+        self.rejected = queue.SimpleQueue()
+        super().__init__(server_address, handler)
+        for _ in range(workers):
+            t = threading.Thread(target=self.worker, daemon=True)
+            t.start()
+            self.workers.append(t)
+        threading.Thread(target=self.rejecter, daemon=True).start()
+
+    def worker(self):
+        while True:
+            item = self.connections.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        try:
+            self.connections.put_nowait((request, client_address))
+        except queue.Full:
+            self.send_busy(request)
+
+    def send_busy(self, request):
+        body = b'{"status":"BUSY"}'
+        reply = b'HTTP/1.0 503 Service Unavailable\r\n' + \
+                b'Content-type: application/json\r\n' + \
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\n' + \
+                b'Retry-After: 1\r\n' + \
+                b'Connection: close\r\n\r\n' + body
+        try:
+            # called from the accept loop: never wait on the client here, the
+            # reply fits in the empty send buffer of a new connection
+            request.setblocking(False)
+            request.send(reply)
+        except OSError:
+            pass
+        self.rejected.put(request)
+
+    def rejecter(self):
+        # Reads the request of each rejected connection before closing it:
+        # closing a socket with unread data resets the connection and the
+        # client may never see the 503
+        while True:
+            request = self.rejected.get()
+            if request is None:
+                break
+            try:
+                request.settimeout(0.1)
+                request.recv(65536)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self.workers:
+            self.connections.put(None)
+        self.rejected.put(None)
 
 
 if __name__ == '__main__':
-    server = ThreadingSimpleServer((hostName, serverPort), Handler)
+    server = ThreadPoolServer((hostName, serverPort), Handler)
     print(f'Starting server.  Waiting on {hostName}:{serverPort}, use <Ctrl-C> or <Command-C> to stop')
     server.serve_forever()
 
@@ -0,0 +1,144 @@
+"""
+Course: CSE 351
+Lesson Week: 10
+File: benchmark.py
+Purpose: Assignment 10 - timing the Family Search parts
+
+Runs the Family Search server in this process and times parts 1 to 3 for
+every number of generations and worker count below.  The server's ids and
+trees come from SEED, so every run retrieves the same tree and runs can be
+compared with each other.
+
+    python benchmark.py
+
+Results are written to REPORT.csv and REPORT.json.  Stop server.py first or
+change PORT, both can't use the same port.  With FAKE_TRANSPORT = True there
+is no socket at all: replies come from fake_transport.py after SLEEP, which
+times the client code by itself (try SLEEP = 0).
+"""
+import contextlib
+import csv
+import json
+import os
+import threading
+import time
+
+import common
+import functions
+import server
+from common import Tree, get_data_from_server
+from fake_transport import FakeTransport
+
+PORT = 8124
+SEED = 351
+SLEEP = 0.25            # server delay per request, seconds
+GENERATIONS = (5, 6, 7)
+REPEAT = 3              # runs of each setting
+REPORT = 'benchmark'
+FAKE_TRANSPORT = False
+
+# part -> (title, function, settings in functions.py, worker counts to try)
+# Part 2's calls also go through an AdaptiveLimiter that stops at LIMIT_MAX
+# by default, so its cap is set to the worker count as well.
+PARTS = {
+    1: ('Depth First Search', functions.depth_fs_pedigree, ('DFS_WORKERS',), (25, 50, 100, 200)),
+    2: ('Breadth First Search', functions.breadth_fs_pedigree, ('NUM_WORKERS', 'BFS_MAX_IN_FLIGHT'), (25, 50, 100, 200)),
+    3: ('Breadth First Search limit N', functions.breadth_fs_pedigree_limit5, ('LIMIT_N',), (5, 10)),
+}
+
+FIELDS = ('part', 'title', 'generations', 'workers', 'run', 'seconds', 'api_calls',
+          'max_threads', 'people', 'families', 'records_per_second', 'complete')
+
+# ----------------------------------------------------------------------------
+def start_server():
+    server.seed_ids(SEED)
+    server.SLEEP = SLEEP
+    server.log.level = server.INFO
+    if FAKE_TRANSPORT:
+        common.set_transport(FakeTransport(SLEEP))
+        return None
+
+    httpd = server.ThreadPoolServer((server.hostName, PORT), server.Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    # functions.py has its own copy from "from common import *"
+    url = f'http://{server.hostName}:{PORT}'
+    common.TOP_API_URL = url
+    functions.TOP_API_URL = url
+    return httpd
+
+
+def run_once(part, generations, workers, run):
+    title, func, settings, _ = PARTS[part]
+    for setting in settings:
+        setattr(functions, setting, workers)
+
+    # the server prints every request order on /end, keep the terminal for results
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        get_data_from_server(f'{common.TOP_API_URL}/start/{generations}?seed={SEED}')
+        start_id = get_data_from_server(common.TOP_API_URL)['start_family_id']
+        tree = Tree(start_id)
+
+        start = time.perf_counter()
+        func(start_id, tree)
+        seconds = time.perf_counter() - start
+
+        server_data = get_data_from_server(f'{common.TOP_API_URL}/end')
+
+    people = tree.get_person_count()
+    families = tree.get_family_count()
+    return {
+        'part': part,
+        'title': title,
+        'generations': generations,
+        'workers': workers,
+        'run': run,
+        'seconds': round(seconds, 5),
+        'api_calls': server_data['api'],
+        'max_threads': server_data['threads'],
+        'people': people,
+        'families': families,
+        'records_per_second': round((people + families) / seconds, 2),
+        'complete': people == server_data['people'] and families == server_data['families'],
+    }
+
+
+def write_report(results):
+    with open(f'{REPORT}.csv', 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+
+    settings = {'seed': SEED, 'sleep': SLEEP, 'generations': GENERATIONS, 'repeat': REPEAT}
+    with open(f'{REPORT}.json', 'w') as file:
+        json.dump({'settings': settings, 'results': results}, file, indent=2)
+
+
+def main():
+    httpd = start_server()
+    where = 'in process, no sockets' if FAKE_TRANSPORT else f'on port {PORT}'
+    print(f'Server {where}, seed {SEED}, sleep {SLEEP}')
+    print(f'{"part":<30} {"gens":>4} {"workers":>7} {"run":>3} {"seconds":>9} {"api":>6} {"threads":>7} {"rec/s":>9}')
+
+    results = []
+    try:
+        for part, (title, _, _, worker_counts) in PARTS.items():
+            for generations in GENERATIONS:
+                for workers in worker_counts:
+                    for run in range(1, REPEAT + 1):
+                        row = run_once(part, generations, workers, run)
+                        results.append(row)
+                        flag = '' if row['complete'] else '  INCOMPLETE'
+                        print(f'{title:<30} {generations:>4} {workers:>7} {run:>3} {row["seconds"]:>9.3f} '
+                              f'{row["api_calls"]:>6} {row["max_threads"]:>7} {row["records_per_second"]:>9.1f}{flag}')
+    finally:
+        write_report(results)
+        if httpd != None:
+            httpd.shutdown()
+            httpd.server_close()
+
+    print(f'Results written to {REPORT}.csv and {REPORT}.json')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,36 +7,466 @@ Don't change this code.  You are not submitting it with your assignment
 
 """
 import time
+import random
+import threading
+import asyncio
+import json
 import requests
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
 
 from cse351 import *
 
 TOP_API_URL = 'http://127.0.0.1:8123'
 
+# Connections are kept open and shared by every thread that calls
+# get_data_from_server().  POOL_SIZE connections are kept per host.
+POOL_SIZE = 100
+
+_session = None
+_session_lock = threading.Lock()
+
+# Calls go to the server over HTTP unless set_transport() was given something
+# else to answer them: an object with get(url) and async get_async(url) that
+# return the decoded JSON reply or None.  See fake_transport.py.
+_transport = None
+
+# Retry policy for get_data_from_server().  Failed calls are retried with
+# exponential backoff and jitter so that threads that failed together don't
+# all retry together.  A call gives up after RETRIES attempts or after
+# RETRY_DEADLINE seconds, whichever comes first.
+RETRIES = 50
+RETRY_BASE_DELAY = 0.01     # seconds, doubles with each attempt
+RETRY_MAX_DELAY = 2.0       # seconds
+RETRY_DEADLINE = 60         # seconds for a call including all of its retries
+REQUEST_TIMEOUT = 10        # seconds for one attempt
+RETRY_STATUS = (500, 502, 503, 504)
+
+# Retries are also limited across all threads: each retry takes a token from
+# a shared budget that refills at RETRY_RATE tokens per second.  When many
+# threads fail at once their retries are spread out at that rate instead of
+# all hitting the server again at the same moment.
+RETRY_BUDGET = 50
+RETRY_RATE = 20             # retries per second for all threads together
+
 # ----------------------------------------------------------------------------
-def get_data_from_server(url):
-    retries = 50
-    delay = 0.01 # seconds
-    for i in range(retries):
+class RetryBudget:
+
+    def __init__(self, size=RETRY_BUDGET, rate=RETRY_RATE):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.size = size
+        self.rate = rate
+        self.tokens = size
+        self.updated = time.monotonic()
+
+    def reserve(self, deadline):
+        # Takes a token and returns how long to wait before it can be used,
+        # None (and no token taken) if that is past the deadline
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.size, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(0, (1 - self.tokens) / self.rate)
+            if now + wait > deadline:
+                return None
+            self.tokens -= 1
+            return wait
+
+retry_budget = RetryBudget()
+
+def retry_delay(attempt, retry_after=0):
+    # "full jitter" backoff, never less than the server's Retry-After
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    return max(delay, retry_after)
+
+def get_retry_after(value):
+    # seconds from a Retry-After header, 0 if there isn't one
+    try:
+        return float(value or 0)
+    except ValueError:
+        return 0
+
+def get_retry_wait(attempt, delay, deadline):
+    # seconds to wait before the next attempt, None to give up
+    if attempt < RETRIES - 1 and time.monotonic() + delay <= deadline:
+        wait = retry_budget.reserve(deadline - delay)
+        if wait is not None:
+            return max(delay, wait)
+    print("Max retries reached. Failing.")
+    return None
+
+# ----------------------------------------------------------------------------
+def set_transport(transport):
+    # None goes back to HTTP
+    global _transport
+    _transport = transport
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+# ----------------------------------------------------------------------------
+# Replies from /person/{id} and /family/{id} don't change until the next
+# /start, so they are kept in a bounded LRU cache.  A thread asking for a URL
+# that another thread is already fetching waits for that call instead of
+# making its own.  Don't change the dicts that come back, they are shared.
+
+CACHE_SIZE = 50000          # replies kept
+CACHED_ROUTES = ('person', 'family')
+
+class ResponseCache:
+
+    def __init__(self, size=CACHE_SIZE):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.size = size
+        self.data = OrderedDict()   # url -> reply, oldest first
+        self.pending = {}           # url -> Event set when its fetch is done
+        self.generation = 0         # bumped by clear()
+
+    def peek(self, url):
+        with self.lock:
+            if url in self.data:
+                self.data.move_to_end(url)
+                return self.data[url]
+            return None
+
+    def put(self, url, value, generation):
+        # replies fetched before the last clear() are dropped
+        with self.lock:
+            if value is None or generation != self.generation:
+                return
+            self.data[url] = value
+            self.data.move_to_end(url)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def get(self, url, fetch):
+        while True:
+            with self.lock:
+                if url in self.data:
+                    self.data.move_to_end(url)
+                    return self.data[url]
+                event = self.pending.get(url)
+                if event is None:
+                    event = self.pending[url] = threading.Event()
+                    generation = self.generation
+                    break
+            # failed calls aren't cached, the waiters then try again themselves
+            event.wait()
+
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            if response.status_code == 200:
-                return response.json()
-            break
+            value = fetch(url)
+            self.put(url, value, generation)
+            return value
+        finally:
+            with self.lock:
+                if self.pending.get(url) is event:
+                    del self.pending[url]
+            event.set()
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.generation += 1
+
+response_cache = ResponseCache()
+
+def get_route(url):
+    # 'person' for http://host:port/person/123
+    return urlsplit(url).path.strip('/').split('/')[0]
 
-        except requests.exceptions.ConnectionError as e:
-            if i < retries - 1:
-                time.sleep(delay)
+# ----------------------------------------------------------------------------
+def get_data_from_server(url):
+    route = get_route(url)
+    if route in CACHED_ROUTES:
+        return response_cache.get(url, _get_data_from_server)
+    if route == 'start':
+        response_cache.clear()
+    return _get_data_from_server(url)
+
+def _get_data_from_server(url):
+    if _transport != None:
+        return _transport.get(url)
+
+    deadline = time.monotonic() + RETRY_DEADLINE
+    for attempt in range(RETRIES):
+        retry_after = 0
+        try:
+            timeout = min(REQUEST_TIMEOUT, max(deadline - time.monotonic(), 0.1))
+            response = get_session().get(url, timeout=timeout)
+            if response.status_code in RETRY_STATUS:
+                # server error or 503 busy, try again after a backoff
+                retry_after = get_retry_after(response.headers.get('Retry-After'))
             else:
-                print("Max retries reached. Failing.")
-                
-        except requests.exceptions.Timeout:
-            ...
+                response.raise_for_status()
+                if response.status_code == 200:
+                    return response.json()
+                break
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            pass
             
         except requests.exceptions.RequestException as e:
             break
 
+        delay = get_retry_wait(attempt, retry_delay(attempt, retry_after), deadline)
+        if delay is None:
+            break
+        time.sleep(delay)
+
+    return None
+
+# ----------------------------------------------------------------------------
+# Adaptive limit on calls in flight (AIMD).  Like TCP the limit starts
+# with a slow start that doubles it every round trip (each call that comes
+# back in time adds one).  After the first backoff each call adds 1/limit,
+# so the limit grows by about one per round trip.  A call that fails or
+# takes LIMIT_SLOW_RATIO times longer than the fastest call seen means the
+# server is queueing: the limit is multiplied by LIMIT_BACKOFF, at most
+# once per round trip.
+
+LIMIT_START = 10
+LIMIT_MIN = 1
+LIMIT_MAX = 100
+LIMIT_BACKOFF = 0.75
+LIMIT_SLOW_RATIO = 2.0
+LIMIT_BASELINE_DRIFT = 1.01     # fastest call seen creeps up by this each call
+
+class AdaptiveLimiter:
+
+    def __init__(self, max_limit=None, start=LIMIT_START):
+        super().__init__()
+        self.condition = threading.Condition()
+        self.max_limit = LIMIT_MAX if max_limit == None else max_limit
+        self.limit = max(LIMIT_MIN, min(start, self.max_limit))
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.fastest = None         # seconds
+        self.last_backoff = 0
+        self.slow_start = True
+
+    def acquire(self):
+        # waits for a free slot, returns the start time to give to release()
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return time.monotonic()
+
+    def release(self, started, ok):
+        now = time.monotonic()
+        latency = now - started
+        with self.condition:
+            self.in_flight -= 1
+            slow = False
+            if ok:
+                if self.fastest == None or latency < self.fastest:
+                    self.fastest = latency
+                else:
+                    # let the baseline recover from one unusually fast call
+                    self.fastest *= LIMIT_BASELINE_DRIFT
+                slow = latency > self.fastest * LIMIT_SLOW_RATIO
+
+            if not ok or slow:
+                # all calls started before the last backoff saw the same queue
+                if started >= self.last_backoff:
+                    self.limit = max(LIMIT_MIN, self.limit * LIMIT_BACKOFF)
+                    self.last_backoff = now
+                    self.slow_start = False
+            elif self.slow_start:
+                self.limit = min(self.max_limit, self.limit + 1)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify(max(1, int(self.limit) - self.in_flight))
+
+    def fetch(self, url):
+        # get_data_from_server() within the limit, cached replies skip it
+        data = response_cache.peek(url)
+        if data != None:
+            return data
+        started = self.acquire()
+        data = None
+        try:
+            data = get_data_from_server(url)
+        finally:
+            self.release(started, data != None)
+        return data
+
+# ----------------------------------------------------------------------------
+# asyncio client: the same calls as get_data_from_server() without a thread
+# per request.  Connections are HTTP/1.1 keep-alive and are shared by all of
+# the coroutines running in one event loop.
+
+ASYNC_POOL_SIZE = 100       # connections open at once per host
+
+class AsyncConnectionPool:
+
+    def __init__(self, size=ASYNC_POOL_SIZE):
+        super().__init__()
+        self.size = size
+        self.idle = {}          # (host, port) -> [(reader, writer), ...]
+        self.limits = {}        # (host, port) -> Semaphore(size)
+        self.pending = {}       # url -> Task for cached routes being fetched
+
+    async def get(self, url, timeout=REQUEST_TIMEOUT):
+        # returns (status code, body bytes, headers)
+        parts = urlsplit(url)
+        host = (parts.hostname, parts.port or 80)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        if host not in self.limits:
+            self.limits[host] = asyncio.Semaphore(self.size)
+            self.idle[host] = []
+
+        async with self.limits[host]:
+            if self.idle[host]:
+                connection = self.idle[host].pop()
+            else:
+                connection = await asyncio.wait_for(asyncio.open_connection(*host), timeout)
+
+            try:
+                status, body, headers, keep_alive = await asyncio.wait_for(self._request(connection, host, path), timeout)
+            except BaseException:
+                connection[1].close()
+                raise
+
+            if keep_alive:
+                self.idle[host].append(connection)
+            else:
+                connection[1].close()
+            return status, body, headers
+
+    async def _request(self, connection, host, path):
+        reader, writer = connection
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: {host[0]}:{host[1]}\r\n\r\n'.encode('latin-1'))
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            # a kept-alive connection the server has since closed
+            raise ConnectionError('Connection closed by server')
+        version, status = status_line.split()[:2]
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+
+        keep_alive = version == b'HTTP/1.1' and headers.get('connection') != 'close'
+        if headers.get('transfer-encoding') == 'chunked':
+            body = b''
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                body += chunk[:-2]
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+
+        return int(status), body, headers, keep_alive
+
+    def close(self):
+        for connections in self.idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self.idle = {}
+
+_async_pools = {}
+
+def get_async_pool():
+    # one pool per event loop, asyncio connections can't move between loops
+    loop = asyncio.get_running_loop()
+    if loop not in _async_pools:
+        _async_pools.clear()
+        _async_pools[loop] = AsyncConnectionPool()
+    return _async_pools[loop]
+
+def run_async(coroutine):
+    # asyncio.run() that closes the pooled connections when it is done, an
+    # idle keep-alive connection holds one of the server's threads
+    async def _run():
+        try:
+            return await coroutine
+        finally:
+            get_async_pool().close()
+            _async_pools.clear()
+    return asyncio.run(_run())
+
+async def fetch_json(url):
+    # get_data_from_server() for coroutines, with the same retry policy and cache
+    route = get_route(url)
+    if route == 'start':
+        response_cache.clear()
+    if route not in CACHED_ROUTES:
+        return await _fetch_json(url)
+
+    value = response_cache.peek(url)
+    if value is not None:
+        return value
+
+    pool = get_async_pool()
+    if url not in pool.pending:
+        async def _fetch(generation):
+            try:
+                value = await _fetch_json(url)
+                response_cache.put(url, value, generation)
+                return value
+            finally:
+                del pool.pending[url]
+        pool.pending[url] = asyncio.ensure_future(_fetch(response_cache.generation))
+
+    # shield() so a cancelled caller doesn't cancel the others' fetch
+    return await asyncio.shield(pool.pending[url])
+
+async def _fetch_json(url):
+    if _transport != None:
+        return await _transport.get_async(url)
+
+    deadline = time.monotonic() + RETRY_DEADLINE
+    for attempt in range(RETRIES):
+        retry_after = 0
+        try:
+            timeout = min(REQUEST_TIMEOUT, max(deadline - time.monotonic(), 0.1))
+            status, body, headers = await get_async_pool().get(url, timeout)
+            if status in RETRY_STATUS:
+                retry_after = get_retry_after(headers.get('retry-after'))
+            else:
+                if status == 200 and body:
+                    return json.loads(body)
+                break
+
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError, OSError):
+            pass
+
+        except ValueError:
+            break
+
+        delay = get_retry_wait(attempt, retry_delay(attempt, retry_after), deadline)
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
+
     return None
 
 # ----------------------------------------------------------------------------
@@ -109,25 +539,63 @@ class Family:
 
 
 # -----------------------------------------------------------------------------
+# The tree can be shared by many threads.  Adding is check-then-insert, so
+# each id is guarded by one of TREE_LOCK_STRIPES locks picked by the id: two
+# threads only wait for each other when their ids land on the same lock.
+
+TREE_LOCK_STRIPES = 64
+
+DISPLAY_CHUNK_LINES = 1000          # lines per log.write() in Tree.display()
+DISPLAY_FILE_BUFFER = 1024 * 1024   # bytes, for the JSON Lines output
+
 class Tree:
 
     def __init__(self, start_family_id):
         super().__init__()
         self.__people = {}
         self.__families = {}
+        self.__claimed = set()      # family ids someone has started to fetch
         self.__start_family_id = start_family_id
+        self.__people_locks = [threading.Lock() for _ in range(TREE_LOCK_STRIPES)]
+        self.__family_locks = [threading.Lock() for _ in range(TREE_LOCK_STRIPES)]
+
+    def __lock(self, locks, id):
+        return locks[hash(id) % len(locks)]
 
     def add_person(self, person):
-        if self.does_person_exist(person.get_id()):
+        if not self.add_person_if_absent(person):
             print(f'ERROR: Person with ID = {person.get_id()} Already exists in the tree')
-        else:
-            self.__people[person.get_id()] = person
 
     def add_family(self, family):
-        if self.does_family_exist(family.get_id()):
+        if not self.add_family_if_absent(family):
             print(f'ERROR: Family with ID = {family.get_id()} Already exists in the tree')
-        else:
-            self.__families[family.get_id()] = family
+
+    def add_person_if_absent(self, person):
+        # True if this call added the person, False if it was already there
+        id = person.get_id()
+        with self.__lock(self.__people_locks, id):
+            if id in self.__people:
+                return False
+            self.__people[id] = person
+            return True
+
+    def add_family_if_absent(self, family):
+        # True if this call added the family, False if it was already there
+        id = family.get_id()
+        with self.__lock(self.__family_locks, id):
+            if id in self.__families:
+                return False
+            self.__families[id] = family
+            return True
+
+    def claim_family(self, id):
+        # True for the first caller only: that caller fetches the family and
+        # everyone else leaves it alone
+        with self.__lock(self.__family_locks, id):
+            if id in self.__claimed or id in self.__families:
+                return False
+            self.__claimed.add(id)
+            return True
 
     def get_person(self, id):
         if id in self.__people:
@@ -153,119 +621,128 @@ class Tree:
     def does_family_exist(self, id):
         return id in self.__families
 
-    def display(self, log):
-        log.write('\n\n')
-        log.write(f'{" TREE DISPLAY ":*^40}')
-        for family_id in self.__families:
-            fam = self.__families[family_id]
-
-            log.write(f'Family id: {family_id}')
+    def display(self, log, jsonl=None):
+        # Families are written DISPLAY_CHUNK_LINES lines at a time instead of
+        # one log.write() per line.  With jsonl set to a filename they go to
+        # that file as JSON Lines instead, one family per line.
+        if jsonl != None:
+            with open(jsonl, 'w', buffering=DISPLAY_FILE_BUFFER) as file:
+                for fam in self.__families.values():
+                    file.write(json.dumps(self._family_record(fam)))
+                    file.write('\n')
+        else:
+            log.write('\n\n')
+            log.write(f'{" TREE DISPLAY ":*^40}')
+            lines = []
+            for fam in self.__families.values():
+                self._family_lines(fam, lines)
+                if len(lines) >= DISPLAY_CHUNK_LINES:
+                    log.write('\n'.join(lines))
+                    lines.clear()
+            if lines:
+                log.write('\n'.join(lines))
+
+        stats = self.stats()
+        log.write('')
+        log.write(f'Number of people                    : {stats["people"]}')
+        log.write(f'Number of families                  : {stats["families"]}')
+        log.write(f'Max generations                     : {stats["generations"]}')
+        log.write(f'People connected to starting family : {stats["connected"]}')
 
-            # Husband
-            husband = self.get_person(fam.get_husband())
-            if husband == None:
-                log.write(f'  Husband: None')
-            else:
-                log.write(f'  Husband: {husband.get_name()}, {husband.get_birth()}')
 
-            # wife
-            wife = self.get_person(fam.get_wife())
-            if wife == None:
-                log.write(f'  Wife: None')
+    def _parent_names(self, person):
+        # (father, mother) names or None if the parents aren't in the tree
+        if person == None or person.get_parentid() not in self.__families:
+            return None
+        parent_fam = self.__families[person.get_parentid()]
+        return tuple(self._name(id) for id in (parent_fam.get_husband(), parent_fam.get_wife()))
+
+    def _name(self, id):
+        person = self.__people.get(id)
+        return None if person == None else person.get_name()
+
+    def _family_lines(self, fam, lines):
+        husband = self.__people.get(fam.get_husband())
+        wife = self.__people.get(fam.get_wife())
+        lines.append(f'Family id: {fam.get_id()}')
+        for title, person in (('Husband', husband), ('Wife', wife)):
+            if person == None:
+                lines.append(f'  {title}: None')
             else:
-                log.write(f'  Wife: {wife.get_name()}, {wife.get_birth()}')
-
-            # Parents of Husband
-            if husband == None:
-                log.write(f'  Husband Parents: None')
+                lines.append(f'  {title}: {person.get_name()}, {person.get_birth()}')
+        for title, person in (('Husband', husband), ('Wife', wife)):
+            parents = self._parent_names(person)
+            if parents == None:
+                lines.append(f'  {title} Parents: None')
             else:
-                parent_fam_id = husband.get_parentid()
-                if parent_fam_id in self.__families:
-                    parent_fam = self.get_family(parent_fam_id)
-                    father = self.get_person(parent_fam.get_husband())
-                    mother = self.get_person(parent_fam.get_wife())
-                    log.write(f'  Husband Parents: {father.get_name()} and {mother.get_name()}')
-                else:
-                    log.write(f'  Husband Parents: None')
-
-            # Parents of Wife
-            if wife == None:
-                log.write(f'  Wife Parents: None')
-            else:
-                parent_fam_id = wife.get_parentid()
-                if parent_fam_id in self.__families:
-                    parent_fam = self.get_family(parent_fam_id)
-                    father = self.get_person(parent_fam.get_husband())
-                    mother = self.get_person(parent_fam.get_wife())
-                    log.write(f'  Wife Parents: {father.get_name()} and {mother.get_name()}')
-                else:
-                    log.write(f'  Wife Parents: None')
-
-            # children
-            output = []
-            for index, child_id in enumerate(fam.get_children()):
-                person = self.__people[child_id]
-                output.append(f'{person.get_name()}')
-            out_str = str(output).replace("'", '', 100)
-            log.write(f'  Children: {out_str[1:-1]}')
-
-        log.write('')
-        log.write(f'Number of people                    : {len(self.__people)}')
-        log.write(f'Number of families                  : {len(self.__families)}')
-        log.write(f'Max generations                     : {self._count_generations(self.__start_family_id)}')
-        log.write(f'People connected to starting family : {self._test_number_connected_to_start()}')
-
+                lines.append(f'  {title} Parents: {parents[0]} and {parents[1]}')
+        children = ', '.join(str(self._name(id)) for id in fam.get_children())
+        lines.append(f'  Children: {children}')
+
+    def _family_record(self, fam):
+        def person_record(id):
+            person = self.__people.get(id)
+            if person == None:
+                return None
+            return {'id': id, 'name': person.get_name(), 'birth': person.get_birth(),
+                    'parents': self._parent_names(person)}
+        return {
+            'id': fam.get_id(),
+            'husband': person_record(fam.get_husband()),
+            'wife': person_record(fam.get_wife()),
+            'children': [self._name(id) for id in fam.get_children()],
+        }
+
+    def stats(self):
+        # counts for the summary, from one walk up from the starting family
+        generations, connected = self._walk_up(self.__start_family_id)
+        return {
+            'people': len(self.__people),
+            'families': len(self.__families),
+            'generations': generations,
+            'connected': connected,
+        }
+
+    def _walk_up(self, family_id):
+        # Returns (generations, people connected) above family_id.  Iterative
+        # with each family's depth memoized, so deep trees don't hit the
+        # recursion limit and shared ancestors are only walked once.
+        depth = {}          # family id -> generations from it up
+        inds_seen = set()
+        visiting = set()
+        stack = [(family_id, False)]
+        while stack:
+            id, parents_done = stack.pop()
+            if id in depth or id not in self.__families:
+                continue
+
+            fam = self.__families[id]
+            parents = []
+            for person_id in (fam.get_husband(), fam.get_wife()):
+                person = self.__people.get(person_id)
+                if person != None and person.get_parentid() in self.__families:
+                    parents.append(person.get_parentid())
+
+            if parents_done:
+                depth[id] = 1 + max((depth.get(parent_id, 0) for parent_id in parents), default=0)
+                continue
+            if id in visiting:
+                continue
+            visiting.add(id)
+
+            for person_id in (fam.get_husband(), fam.get_wife()):
+                if person_id in self.__people:
+                    inds_seen.add(person_id)
+            inds_seen.update(fam.get_children())
+
+            stack.append((id, True))
+            stack.extend((parent_id, False) for parent_id in parents if parent_id not in depth)
+
+        return depth.get(family_id, 0), len(inds_seen)
 
     def _test_number_connected_to_start(self):
         # start with first family, how many connected to that family
-        inds_seen = set()
-
-        def _recurive(family_id):
-            nonlocal inds_seen
-            if family_id in self.__families:
-                # count people in this family
-                fam = self.__families[family_id]
-
-                husband = self.get_person(fam.get_husband())
-                if husband != None:
-                    if husband.get_id() not in inds_seen:
-                        inds_seen.add(husband.get_id())
-                    _recurive(husband.get_parentid())
-                
-                wife = self.get_person(fam.get_wife())
-                if wife != None:
-                    if wife.get_id() not in inds_seen:
-                        inds_seen.add(wife.get_id())
-                    _recurive(wife.get_parentid())
-
-                for child_id in fam.get_children():
-                    if child_id not in inds_seen:
-                        inds_seen.add(child_id)
-
-
-        _recurive(self.__start_family_id)
-        return len(inds_seen)
-
+        return self._walk_up(self.__start_family_id)[1]
 
     def _count_generations(self, family_id):
-        max_gen = -1
-
-        def _recurive_gen(id, gen):
-            nonlocal max_gen
-            if id in self.__families:
-                if max_gen < gen:
-                    max_gen = gen
-
-                fam = self.__families[id]
-
-                husband = self.get_person(fam.get_husband())
-                if husband != None:
-                    _recurive_gen(husband.get_parentid(), gen + 1)
-                
-                wife = self.get_person(fam.get_wife())
-                if wife != None:
-                    _recurive_gen(wife.get_parentid(), gen + 1)
-
-        _recurive_gen(family_id, 0)
-        return max_gen + 1
-
+        return self._walk_up(family_id)[0]
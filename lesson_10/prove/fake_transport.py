@@ -0,0 +1,80 @@
+"""
+Course: CSE 351
+Lesson Week: 10
+File: fake_transport.py
+Purpose: Assignment 10 - Family Search without a server process
+
+Answers get_data_from_server() calls from the server code in this process
+instead of over a socket.  The replies (ids, trees, /start and /end) are the
+ones server.py would send, only the network is gone.  A /pedigree stream
+comes back as a list with one decoded family per line.  The delay of each
+reply can be set, so the client's own overhead (threads, locks, Tree
+inserts) can be timed with no delay at all.
+
+    import common
+    from fake_transport import FakeTransport
+
+    common.set_transport(FakeTransport())                     # no delay
+    common.set_transport(FakeTransport(0.25))                 # like server.py
+    common.set_transport(FakeTransport(lambda: random.expovariate(4)))
+"""
+import asyncio
+import json
+import time
+from urllib.parse import urlparse
+
+import server
+
+# ----------------------------------------------------------------------------
+class FakeTransport:
+    """ latency is the seconds to wait before each reply: a number, or a
+        function that returns one (called once per request). """
+
+    def __init__(self, latency=0):
+        super().__init__()
+        self.latency = latency
+        server.log.level = server.INFO
+
+    def get_delay(self):
+        return self.latency() if callable(self.latency) else self.latency
+
+    def get(self, url):
+        request = self._start(url)
+        delay = self.get_delay()
+        if delay > 0:
+            time.sleep(delay)
+        return self._finish(request)
+
+    async def get_async(self, url):
+        request = self._start(url)
+        delay = self.get_delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self._finish(request)
+
+    def _start(self, url):
+        # counted as an API call from here, like a request the server accepted
+        url = urlparse(url)
+        path = url.path + ('?' + url.query if url.query else '')
+        if url.path == '/metrics':
+            return url, path, None
+        return url, path, server.start_request(path)
+
+    def _finish(self, request):
+        # the decoded JSON reply, None for a 404 like get_data_from_server()
+        url, path, started = request
+        if started == None:
+            return json.loads(server.get_metrics_json())
+
+        if url.path.startswith('/pedigree/'):
+            lines = server.get_pedigree_lines(url)
+            lines = None if lines == None else list(lines)
+            sent = sum(len(line) for line in lines or [])
+            reply = None if lines == None else [json.loads(line) for line in lines]
+        else:
+            json_data = server.get_reply(url)
+            sent = len(json_data or b'')
+            reply = None if json_data == None else json.loads(json_data)
+
+        server.finish_request(path, started, 404 if reply == None else 200, sent)
+        return reply
@@ -15,23 +15,38 @@ https://www.youtube.com/watch?v=86g8jAQug04
 You will lose 10% if you don't detail your part 1 and part 2 code below
 
 Describe how to speed up part 1
-I parallelized the DFS so that fetching each husband, wife, and each child happens in its own thread. 
-As soon as I get a person’s data, I use a recursive DFS for their parent and family.
+A fixed pool of worker threads takes single requests from a LIFO queue, so the deepest work is 
+always done first. When a family arrives its husband, wife and children are queued, and as soon 
+as a husband or wife arrives their parent family is queued on top. Without a thread per person 
+there is no thread creation or joining as the tree gets deeper.
 
 Describe how to speed up part 2
 I use a pool of worker threads consuming from a shared family queue.Each worker fetches a family, 
 adds it if unseen, then fetches all its people in order. When a person’s parent‐family appears, 
-it’s enqueued. Multiple workers will allow me to complete this for multiple families at once.
+the first worker to claim it in the tree enqueues it. Multiple workers will allow me to complete this for multiple families at once.
 
 Extra (Optional) 10% Bonus to speed up part 3
-Wrap the same worker/pool approach with a threading.Semaphore(5) around 
-eachget_data_from_server to limit the calls to 5.
+5 worker threads take single requests from a priority queue, families first, then husbands 
+and wives, then children. The limit applies per call, so all 5 connections stay busy instead 
+of a worker holding a slot while it steps through one family's people. Part 2 sends its calls 
+through an AdaptiveLimiter so the number in flight follows how fast the server is answering.
 """
 from common import *
+import asyncio
+import itertools
 import queue
 import threading
 
 NUM_WORKERS = 100
+DFS_WORKERS = 100           # threads for part 1
+BFS_MAX_IN_FLIGHT = None    # part 2 limiter's max_limit, None for LIMIT_MAX
+LIMIT_N = 5                 # calls in flight for part 3
+
+# kinds of fetches, for part 3 also their priority, lowest first
+FETCH_FAMILY = 0
+FETCH_PARENT = 1
+FETCH_CHILD = 2
+FETCH_DONE = 3
 
 # -----------------------------------------------------------------------------
 def depth_fs_pedigree(family_id, tree):
@@ -39,68 +54,55 @@ def depth_fs_pedigree(family_id, tree):
     # TODO - implement Depth first retrieval
     # TODO - Printing out people and families that are retrieved from the server will help debugging
 
-    def dfs_family(fam_id):
-        fam_data = get_data_from_server(f"{TOP_API_URL}/family/{fam_id}")
-        if not fam_data:
-            return
+    # DFS_WORKERS threads take single requests from a LIFO queue, so the
+    # newest (deepest) work is always done first.  A family's husband and
+    # wife are pushed last, and each parent family is pushed as soon as its
+    # person arrives, so parent families are followed before the children
+    # of the families below them are fetched.
+    tasks = queue.LifoQueue()
 
-        fam = Family(fam_data)
-        if not tree.does_family_exist(fam.get_id()):
-            tree.add_family(fam)
-
-        threads = []
-
-        # process husband
-        hid = fam_data.get('husband_id')
-        if hid is not None:
-            def handle_husband():
-                p_data = get_data_from_server(f"{TOP_API_URL}/person/{hid}")
-                if not p_data:
-                    return
-                person = Person(p_data)
-                if not tree.does_person_exist(person.get_id()):
-                    tree.add_person(person)
-                parent_fam = p_data.get('parent_id')
-                if parent_fam and not tree.does_family_exist(parent_fam):
-                    dfs_family(parent_fam)
-            t = threading.Thread(target=handle_husband)
-            t.start()
-            threads.append(t)
-
-        # process wife
-        wid = fam_data.get('wife_id')
-        if wid is not None:
-            def handle_wife():
-                p_data = get_data_from_server(f"{TOP_API_URL}/person/{wid}")
-                if not p_data:
-                    return
-                person = Person(p_data)
-                if not tree.does_person_exist(person.get_id()):
-                    tree.add_person(person)
-                parent_fam = p_data.get('parent_id')
-                if parent_fam and not tree.does_family_exist(parent_fam):
-                    dfs_family(parent_fam)
-            t = threading.Thread(target=handle_wife)
-            t.start()
-            threads.append(t)
-
-        # process children
-        for cid in fam_data.get('children', []):
-            def handle_child(child_id=cid):
-                p_data = get_data_from_server(f"{TOP_API_URL}/person/{child_id}")
-                if not p_data:
-                    return
-                child = Person(p_data)
-                if not tree.does_person_exist(child.get_id()):
-                    tree.add_person(child)
-            t = threading.Thread(target=handle_child)
-            t.start()
-            threads.append(t)
+    def add_family(fam_id):
+        tasks.put((FETCH_FAMILY, f"{TOP_API_URL}/family/{fam_id}"))
 
-        for t in threads:
-            t.join()
+    def worker():
+        while True:
+            kind, url = tasks.get()
+            if url is None:
+                tasks.task_done()
+                break
 
-    dfs_family(family_id)
+            try:
+                data = get_data_from_server(url)
+                if not data:
+                    continue
+
+                if kind == FETCH_FAMILY:
+                    tree.add_family_if_absent(Family(data))
+                    for cid in reversed(data.get('children', [])):
+                        tasks.put((FETCH_CHILD, f"{TOP_API_URL}/person/{cid}"))
+                    for pid in (data.get('wife_id'), data.get('husband_id')):
+                        if pid is not None:
+                            tasks.put((FETCH_PARENT, f"{TOP_API_URL}/person/{pid}"))
+                else:
+                    tree.add_person_if_absent(Person(data))
+                    parent_fam = data.get('parent_id')
+                    if kind == FETCH_PARENT and parent_fam and tree.claim_family(parent_fam):
+                        add_family(parent_fam)
+            finally:
+                tasks.task_done()
+
+    tree.claim_family(family_id)
+    add_family(family_id)
+
+    workers = [threading.Thread(target=worker) for _ in range(DFS_WORKERS)]
+    for w in workers:
+        w.start()
+
+    tasks.join()
+    for _ in workers:
+        tasks.put((FETCH_DONE, None))
+    for w in workers:
+        w.join()
 
 
 # -----------------------------------------------------------------------------
@@ -110,9 +112,10 @@ def breadth_fs_pedigree(family_id, tree):
     # TODO - Printing out people and families that are retrieved from the server will help debugging
 
     fam_queue = queue.Queue()
+    tree.claim_family(family_id)
     fam_queue.put(family_id)
 
-    tree_lock = threading.Lock()
+    limiter = AdaptiveLimiter(max_limit=BFS_MAX_IN_FLIGHT)
 
     def worker():
         while True:
@@ -121,25 +124,19 @@ def breadth_fs_pedigree(family_id, tree):
                 fam_queue.task_done()
                 break
 
-            fam_data = get_data_from_server(f"{TOP_API_URL}/family/{fam_id}")
+            fam_data = limiter.fetch(f"{TOP_API_URL}/family/{fam_id}")
             if fam_data:
-                fam = Family(fam_data)
-                with tree_lock:
-                    if not tree.does_family_exist(fam.get_id()):
-                        tree.add_family(fam)
+                tree.add_family_if_absent(Family(fam_data))
 
                 for pid in (fam_data.get('husband_id'), fam_data.get('wife_id')) + tuple(fam_data.get('children', [])):
                     if pid is None:
                         continue
-                    p_data = get_data_from_server(f"{TOP_API_URL}/person/{pid}")
+                    p_data = limiter.fetch(f"{TOP_API_URL}/person/{pid}")
                     if not p_data:
                         continue
-                    person = Person(p_data)
-                    with tree_lock:
-                        if not tree.does_person_exist(person.get_id()):
-                            tree.add_person(person)
+                    tree.add_person_if_absent(Person(p_data))
                     parent_fam = p_data.get('parent_id')
-                    if parent_fam and not tree.does_family_exist(parent_fam):
+                    if parent_fam and tree.claim_family(parent_fam):
                         fam_queue.put(parent_fam)
 
             fam_queue.task_done()
@@ -165,51 +162,127 @@ def breadth_fs_pedigree_limit5(family_id, tree):
     #      - Limit number of concurrent connections to the FS server to 5
     # TODO - Printing out people and families that are retrieved from the server will help debugging
 
-    fam_queue = queue.Queue()
-    fam_queue.put(family_id)
+    # One request per task: LIMIT_N workers each make one call at a time, so
+    # all LIMIT_N connections stay busy while there is anything to fetch.
+    # Families go first, then husbands and wives (they lead to the next
+    # families), then children.  Ties are first come first served.  There is
+    # no AdaptiveLimiter here: LIMIT_N is a hard cap already, and backing off
+    # below it would only leave allowed connections idle.
+    tasks = queue.PriorityQueue()
+    order = itertools.count()
 
-    sem = threading.Semaphore(5)
-    tree_lock = threading.Lock()
+    def add(priority, url):
+        tasks.put((priority, next(order), url))
 
     def worker():
         while True:
-            fam_id = fam_queue.get()
-            if fam_id is None:
-                fam_queue.task_done()
+            priority, _, url = tasks.get()
+            if url is None:
+                tasks.task_done()
                 break
 
-            sem.acquire()
             try:
-                fam_data = get_data_from_server(f"{TOP_API_URL}/family/{fam_id}")
-                if fam_data:
-                    fam = Family(fam_data)
-                    with tree_lock:
-                        if not tree.does_family_exist(fam.get_id()):
-                            tree.add_family(fam)
-
-                    for pid in (fam_data.get('husband_id'), fam_data.get('wife_id')) + tuple(fam_data.get('children', [])):
-                        if pid is None:
-                            continue
-                        p_data = get_data_from_server(f"{TOP_API_URL}/person/{pid}")
-                        if not p_data:
-                            continue
-                        person = Person(p_data)
-                        with tree_lock:
-                            if not tree.does_person_exist(person.get_id()):
-                                tree.add_person(person)
-                        parent_fam = p_data.get('parent_id')
-                        if parent_fam and not tree.does_family_exist(parent_fam):
-                            fam_queue.put(parent_fam)
+                data = get_data_from_server(url)
+                if not data:
+                    continue
+
+                if priority == FETCH_FAMILY:
+                    tree.add_family_if_absent(Family(data))
+                    for pid in (data.get('husband_id'), data.get('wife_id')):
+                        if pid is not None:
+                            add(FETCH_PARENT, f"{TOP_API_URL}/person/{pid}")
+                    for cid in data.get('children', []):
+                        add(FETCH_CHILD, f"{TOP_API_URL}/person/{cid}")
+                else:
+                    tree.add_person_if_absent(Person(data))
+                    parent_fam = data.get('parent_id')
+                    if parent_fam and tree.claim_family(parent_fam):
+                        add(FETCH_FAMILY, f"{TOP_API_URL}/family/{parent_fam}")
             finally:
-                sem.release()
-                fam_queue.task_done()
+                tasks.task_done()
 
-    workers = [threading.Thread(target=worker) for _ in range(NUM_WORKERS)]
+    tree.claim_family(family_id)
+    add(FETCH_FAMILY, f"{TOP_API_URL}/family/{family_id}")
+
+    workers = [threading.Thread(target=worker) for _ in range(LIMIT_N)]
     for w in workers:
         w.start()
 
-    fam_queue.join()
+    tasks.join()
     for _ in workers:
-        fam_queue.put(None)
+        add(FETCH_DONE, None)
     for w in workers:
         w.join()
+
+
+# -----------------------------------------------------------------------------
+async def depth_fs_pedigree_async(family_id, tree):
+    # Depth first retrieval on one thread: each family's people are fetched
+    # together with asyncio.gather() and each parent family is followed as
+    # soon as the husband or wife it belongs to arrives.
+
+    async def dfs_person(pid, follow_parents):
+        p_data = await fetch_json(f"{TOP_API_URL}/person/{pid}")
+        if not p_data:
+            return
+        tree.add_person_if_absent(Person(p_data))
+        parent_fam = p_data.get('parent_id')
+        if follow_parents and parent_fam and tree.claim_family(parent_fam):
+            await dfs_family(parent_fam)
+
+    async def dfs_family(fam_id):
+        fam_data = await fetch_json(f"{TOP_API_URL}/family/{fam_id}")
+        if not fam_data:
+            return
+
+        if not tree.add_family_if_absent(Family(fam_data)):
+            return
+
+        people = []
+        for pid in (fam_data.get('husband_id'), fam_data.get('wife_id')):
+            if pid is not None:
+                people.append(dfs_person(pid, True))
+        for cid in fam_data.get('children', []):
+            people.append(dfs_person(cid, False))
+        await asyncio.gather(*people)
+
+    tree.claim_family(family_id)
+    await dfs_family(family_id)
+
+
+# -----------------------------------------------------------------------------
+async def breadth_fs_pedigree_async(family_id, tree):
+    # Breadth first retrieval one generation at a time: all families of a
+    # generation are fetched at once, then all of their people, whose parent
+    # families make up the next generation.
+
+    async def get_person(pid):
+        p_data = await fetch_json(f"{TOP_API_URL}/person/{pid}")
+        if not p_data:
+            return None
+        tree.add_person_if_absent(Person(p_data))
+        return p_data
+
+    tree.claim_family(family_id)
+    generation = [family_id]
+    while generation:
+        families = await asyncio.gather(*(fetch_json(f"{TOP_API_URL}/family/{fam_id}") for fam_id in generation))
+
+        pids = []
+        for fam_data in families:
+            if not fam_data:
+                continue
+            if not tree.add_family_if_absent(Family(fam_data)):
+                continue
+            pids.extend(pid for pid in (fam_data.get('husband_id'), fam_data.get('wife_id')) if pid is not None)
+            pids.extend(fam_data.get('children', []))
+
+        people = await asyncio.gather(*(get_person(pid) for pid in pids))
+
+        generation = []
+        for p_data in people:
+            if p_data is None:
+                continue
+            parent_fam = p_data.get('parent_id')
+            if parent_fam and tree.claim_family(parent_fam):
+                generation.append(parent_fam)
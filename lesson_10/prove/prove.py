@@ -7,12 +7,16 @@ Purpose: Assignment 10 - Family Search
 """
 from common import *
 from functions import depth_fs_pedigree, breadth_fs_pedigree, breadth_fs_pedigree_limit5
+from functions import depth_fs_pedigree_async, breadth_fs_pedigree_async
+import asyncio
 
 from cse351 import *
 
 DFS = 'Depth First Search'
 BFS = 'Breadth First Search'
 BFS5 = 'Breadth First Search limit 5'
+DFS_ASYNC = 'Depth First Search (asyncio)'
+BFS_ASYNC = 'Breadth First Search (asyncio)'
 
 def run_part(log, start_id, generations, title, func):
     tree = Tree(start_id)
@@ -23,7 +27,10 @@ def run_part(log, start_id, generations, title, func):
     log.write('#' * 45)
     log.start_timer(f'{title}: {generations} generations')
     log.write('#' * 45)
-    func(start_id, tree)
+    if asyncio.iscoroutinefunction(func):
+        run_async(func(start_id, tree))
+    else:
+        func(start_id, tree)
     total_time = log.stop_timer()
 
     server_data = get_data_from_server(f'{TOP_API_URL}/end')
@@ -66,6 +73,10 @@ def main():
                 run_part(log, start_id, generations, BFS, breadth_fs_pedigree)
             elif part_to_run == 3:
                 run_part(log, start_id, generations, BFS5, breadth_fs_pedigree_limit5)
+            elif part_to_run == 4:
+                run_part(log, start_id, generations, DFS_ASYNC, depth_fs_pedigree_async)
+            elif part_to_run == 5:
+                run_part(log, start_id, generations, BFS_ASYNC, breadth_fs_pedigree_async)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+"""
+Course: CSE 351
+Lesson Week: 10
+File: replay.py
+Purpose: Assignment 10 - send a recorded request trace back to the server
+
+Record a trace while running a client (prove.py for example):
+
+    python server.py --seed 351 --trace trace.jsonl
+
+then start the server again with the same seed (with or without changes to
+it), so the ids in the trace are valid, and replay it:
+
+    python server.py --seed 351
+
+    python replay.py trace.jsonl        same timing as the trace
+    python replay.py trace.jsonl 2      twice as fast
+    python replay.py trace.jsonl 0.5    half as fast
+
+Each request is sent at the time it arrived in the trace, divided by the
+speed, whatever happened to the requests before it.  That keeps the bursts
+of the original client even if the server is slower this time.  A request
+that has to wait for one of the REPLAY_WORKERS threads is counted as late.
+"""
+import json
+import math
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common import TOP_API_URL, REQUEST_TIMEOUT
+
+# Requests that can be waiting on the server at once, and connections kept
+# open to it.  More than the server's POOL_WORKERS would only wait in its
+# queue or get 503 replies, which isn't how the traced client ran.
+REPLAY_WORKERS = 128
+LATE = 0.01                 # seconds, requests sent later than this are counted
+
+# ----------------------------------------------------------------------------
+def load_trace(filename):
+    with open(filename) as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    records.sort(key=lambda record: record['arrival'])
+    return records
+
+
+def percentile(samples, pct):
+    if len(samples) == 0:
+        return 0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, math.ceil(pct / 100 * len(samples)) - 1)]
+
+
+def replay(records, speed=1.0):
+    # returns one (record, status, latency, late) per request
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=REPLAY_WORKERS)
+    session.mount('http://', adapter)
+
+    results = []
+    results_lock = threading.Lock()
+
+    def send(record, due):
+        started = time.perf_counter()
+        # late when no replay thread was free to send it on time
+        late = started - due > LATE
+        try:
+            status = session.get(f'{TOP_API_URL}{record["path"]}', timeout=REQUEST_TIMEOUT).status_code
+        except requests.exceptions.RequestException:
+            status = None
+        latency = time.perf_counter() - started
+        with results_lock:
+            results.append((record, status, latency, late))
+
+    first = records[0]['arrival'] if records else 0
+    with ThreadPoolExecutor(max_workers=REPLAY_WORKERS) as executor:
+        start = time.perf_counter()
+        for record in records:
+            due = start + (record['arrival'] - first) / speed
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            executor.submit(send, record, due)
+
+    session.close()
+    return results
+
+
+def print_summary(records, results, speed, seconds):
+    traced = (records[-1]['arrival'] - records[0]['arrival']) / speed if records else 0
+    print(f'Requests          : {len(results)}')
+    print(f'Replay time       : {seconds:.3f} seconds (trace {traced:.3f} at speed {speed})')
+    print(f'Sent late (>{LATE}s): {sum(1 for *_, late in results if late)}')
+
+    statuses = {}
+    for _, status, _, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    print(f'Status codes      : {statuses}')
+
+    print()
+    print(f'{"route":<10} {"requests":>8} {"p50":>8} {"p95":>8} {"p99":>8} {"traced p50":>11}')
+    routes = sorted(set(record['route'] for record, *_ in results))
+    for route in routes:
+        latencies = [latency for record, _, latency, _ in results if record['route'] == route]
+        traced = [record['finish'] - record['arrival'] for record, *_ in results if record['route'] == route]
+        print(f'{route:<10} {len(latencies):>8} {percentile(latencies, 50):>8.3f} {percentile(latencies, 95):>8.3f} '
+              f'{percentile(latencies, 99):>8.3f} {percentile(traced, 50):>11.3f}')
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('usage: python replay.py trace.jsonl [speed]')
+        return
+
+    records = load_trace(sys.argv[1])
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    print(f'Replaying {len(records)} requests from {sys.argv[1]} to {TOP_API_URL}')
+
+    start = time.perf_counter()
+    results = replay(records, speed)
+    print_summary(records, results, speed, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main()
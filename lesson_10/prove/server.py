@@ -9,6 +9,11 @@ Instructions:
 
 Open a terminal window and run this program
 
+    python server.py            thread pool server
+    python server.py --async    asyncio server, same API
+    python server.py --trace [file]    also write a request trace (replay.py)
+    python server.py --seed N   same ids and trees on every run
+
 *******************  DO NOT MODIFY!!!!  *********************
 *******************  DO NOT MODIFY!!!!  *********************
 *******************  DO NOT MODIFY!!!!  *********************
@@ -20,19 +25,59 @@ Open a terminal window and run this program
 """
 
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from socketserver import ThreadingMixIn
+from http import HTTPStatus
+import asyncio
 import datetime
 import json
 import time
 import random
 import threading
+import bisect
+import math
+import atexit
+import queue
+import selectors
+import socket
 import ast
+import sys
+from collections import deque
+from urllib.parse import urlparse, parse_qs
 
 hostName = "127.0.0.1"
 serverPort = 8123
 
 SLEEP = 0.25
 MAX_GENERATIONS = 6
+MAX_BATCH_SIZE = 500
+
+# HTTP/1.1 persistent connections.  Idle connections wait for their next
+# request without a server thread and are closed after KEEP_ALIVE_TIMEOUT.
+KEEP_ALIVE = True
+KEEP_ALIVE_TIMEOUT = 10
+
+# Fixed size pool of server threads and the number of connections that can
+# wait for one.  Anything beyond that gets a 503 busy reply.
+POOL_WORKERS = 128
+POOL_BACKLOG = 512
+
+# Log levels and settings for the server log
+DEBUG = 10          # every request and reply
+INFO = 20           # tree / session summaries
+LOG_LEVEL = DEBUG
+LOG_FLUSH_INTERVAL = 0.5    # seconds
+LOG_PAYLOADS = True         # False logs the size of each reply, not the JSON
+
+# Request trace, one JSON line per request when it finishes: route, path,
+# when it arrived, started and finished (seconds since the trace started),
+# thread id, status and bytes sent.  replay.py sends a trace back to the
+# server at the same or a scaled rate.
+TRACE_FILE = 'trace.jsonl'
+
+# /metrics latency histogram bucket upper bounds (seconds) and how many recent
+# requests per route are kept for the percentiles
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+METRICS_SAMPLES = 10000
+ROUTES = ('start', 'end', 'person', 'family', 'people', 'families', 'pedigree')
 
 primes = (5000007787, 5000007797, 5000007799, 5000007811, 5000007823, 5000007829, 5000007877, 5000007899,
             5000007911, 5000007919, 5000007953, 5000007977, 5000007983, 5000008007, 5000008037, 5000008043, 5000008109, 5000008121,
@@ -79,6 +124,11 @@ lock = threading.Lock()
 family_request_order = []
 people = {}
 families = {}
+
+# UTF-8 JSON of each record, made the first time the record is sent and
+# thrown away when the next tree is built
+person_json = {}
+family_json = {}
 generations_created = 0
 
 
@@ -92,15 +142,17 @@ def get_name_female():
 def get_surname():
     return random.choice(surnames)
 
+START_DATE = datetime.date(1753, 1, 1)
+DAYS_BETWEEN_DATES = (datetime.date(2020, 1, 1) - START_DATE).days
+
 def get_date():
-    start_date = datetime.date(1753, 1, 1)
-    end_date = datetime.date(2020, 1, 1)
+    # Dates are kept as a number of days after START_DATE and only turned
+    # into a string when a person is sent, see format_date()
+    return random.randrange(DAYS_BETWEEN_DATES)
 
-    time_between_dates = end_date - start_date
-    days_between_dates = time_between_dates.days
-    random_number_of_days = random.randrange(days_between_dates)
-    random_date = start_date + datetime.timedelta(days=random_number_of_days)
-    return f'{random_date.day}-{random_date.month}-{random_date.year}'
+def format_date(days):
+    date = START_DATE + datetime.timedelta(days=days)
+    return f'{date.day}-{date.month}-{date.year}'
 
 def encode(id: int):
     if id == None:
@@ -114,39 +166,227 @@ def decode(code: int):
     else:
         return (code ^ PRIME) // ID
 
+def decode_ids(query):
+    # "ids=a,b,c" -> list of decoded ids, None if missing or not valid
+    values = parse_qs(query).get('ids')
+    if values == None:
+        return None
+    try:
+        ids = [decode(int(code)) for code in ','.join(values).split(',') if code != '']
+    except ValueError:
+        return None
+    if len(ids) == 0 or len(ids) > MAX_BATCH_SIZE:
+        return None
+    return ids
+
+# /start without ?seed= uses this seed for the tree, None for a random tree
+tree_seed = None
+
+def seed_ids(seed):
+    # PRIME and ID are picked at random when the server starts.  Picking them
+    # from a seed gives the same encoded ids on every run (see benchmark.py).
+    global PRIME
+    global ID
+    global tree_seed
+    tree_seed = seed
+    rnd = random.Random(seed)
+    PRIME = rnd.choice(primes)
+    ID = rnd.randint(10000, 10000000)
+
+# ----------------------------------------------------------------------------
 class Log:
+    """ Buffered log file.  write() only queues the line, a background thread
+        writes whatever has been queued in one batch and flushes the file at
+        most every flush_interval seconds.  Lines below level are dropped.
+        With payloads=False, write_payload() logs the size of a reply instead
+        of the reply itself. """
 
-    def __init__(self, filename):
+    def __init__(self, filename, level=LOG_LEVEL, flush_interval=LOG_FLUSH_INTERVAL, payloads=LOG_PAYLOADS):
         super().__init__()
-        self.lock = threading.Lock()
         self.filename = filename
+        self.level = level
+        self.flush_interval = flush_interval
+        self.payloads = payloads
+        self.lines = queue.SimpleQueue()
+        self.closed = False
         self.file = open(filename, 'w')
+        self.writer = threading.Thread(target=self._write_lines, daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def write(self, line, level=INFO, show=False):
+        # show=True also prints the line on the terminal from the writer
+        # thread, so request threads never wait on the console
+        if level >= self.level:
+            self.lines.put((line, show))
+
+    def write_payload(self, label, payload, level=DEBUG, show=False):
+        if self.payloads:
+            if isinstance(payload, bytes):
+                payload = payload.decode("utf8")
+            self.write(f'{label}: {payload}', level, show)
+        else:
+            self.write(f'{label}: {len(payload)} bytes', level, show)
 
-    def write(self, line):
-        with self.lock:
-            self.file.write(line)
-            self.file.write('\n')
-            self.file.flush()
+    def _write_lines(self):
+        last_flush = time.time()
+        while True:
+            try:
+                batch = [self.lines.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                self.file.flush()
+                last_flush = time.time()
+                continue
+
+            while True:
+                try:
+                    batch.append(self.lines.get_nowait())
+                except queue.Empty:
+                    break
+
+            closing = None in batch
+            if closing:
+                batch = batch[:batch.index(None)]
+
+            if batch:
+                self.file.write('\n'.join(line for line, _ in batch) + '\n')
+                shown = [line for line, show in batch if show]
+                if shown:
+                    print('\n'.join(shown))
+
+            if closing or time.time() - last_flush >= self.flush_interval:
+                self.file.flush()
+                last_flush = time.time()
+
+            if closing:
+                self.file.close()
+                return
 
-    def __del__(self):
-        self.file.close()
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.lines.put(None)
+            self.writer.join()
 
 # Global log object
 log = Log('server.log')
 
+# ----------------------------------------------------------------------------
+class Metrics:
+    """ Per route request counts, bytes sent, 404s and latency for /metrics.
+        Latency is kept both as histogram buckets and as the most recent
+        METRICS_SAMPLES requests, which the p50 / p95 / p99 come from. """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.reset()
+
+    def reset(self):
+        # requests already in flight are still counted when they finish
+        with self.lock:
+            self.started = time.time()
+            self.routes = {}
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+        return time.perf_counter()
+
+    def finish(self, route, started, status, sent):
+        latency = time.perf_counter() - started
+        with self.lock:
+            self.in_flight -= 1
+            stats = self.routes.get(route)
+            if stats == None:
+                stats = {
+                    'requests': 0,
+                    'not_found': 0,
+                    'bytes_sent': 0,
+                    'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+                    'samples': deque(maxlen=METRICS_SAMPLES),
+                }
+                self.routes[route] = stats
+            stats['requests'] += 1
+            if status == 404:
+                stats['not_found'] += 1
+            stats['bytes_sent'] += sent
+            stats['buckets'][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            stats['samples'].append(latency)
+
+    def get_dict(self):
+        with self.lock:
+            routes = {}
+            for route, stats in self.routes.items():
+                samples = sorted(stats['samples'])
+                # cumulative like a Prometheus histogram: requests <= bound
+                buckets = {}
+                total = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('inf',), stats['buckets']):
+                    total += count
+                    buckets[f'le_{bound}'] = total
+                routes[route] = {
+                    'requests': stats['requests'],
+                    'not_found': stats['not_found'],
+                    'bytes_sent': stats['bytes_sent'],
+                    'p50': percentile(samples, 50),
+                    'p95': percentile(samples, 95),
+                    'p99': percentile(samples, 99),
+                    'histogram': buckets,
+                }
+            return {
+                'uptime': time.time() - self.started,
+                'in_flight': self.in_flight,
+                'requests': sum(r['requests'] for r in routes.values()),
+                'not_found': sum(r['not_found'] for r in routes.values()),
+                'bytes_sent': sum(r['bytes_sent'] for r in routes.values()),
+                'routes': routes,
+            }
+
+def percentile(samples, pct):
+    # nearest rank percentile of a sorted list
+    if not samples:
+        return None
+    index = max(math.ceil(pct / 100 * len(samples)) - 1, 0)
+    return samples[index]
+
+def route_name(path):
+    # first part of the path: /person/123 -> "person"
+    name = urlparse(path).path.strip('/').split('/')[0]
+    if name == '':
+        return 'top'
+    return name if name in ROUTES else 'other'
+
+# Global metrics object
+metrics = Metrics()
+
+# Trace log and the time it started, set by open_trace()
+trace = None
+trace_epoch = 0
+
+def open_trace(filename=TRACE_FILE):
+    global trace
+    global trace_epoch
+    trace_epoch = time.perf_counter()
+    trace = Log(filename, level=INFO)
+
 # ----------------------------------------------------------------------------
 class Person:
+
+    # large trees hold millions of people, __slots__ keeps each one small
+    __slots__ = ('id', 'name', 'parents', 'family', 'birth_days')
     
     def __init__(self, id, name):
-        super().__init__()
         self.id = id
         self.name = name
         self.parents = None
         self.family = None
-        self.birth = get_date()
+        self.birth_days = get_date()
 
-    def add_birth(self, date_str):
-        self.birth = date_str
+    @property
+    def birth(self):
+        return format_date(self.birth_days)
 
     def add_parents(self, id):
         self.parents = id
@@ -174,29 +414,41 @@ class Person:
 
         return output
 
+def get_person_dict(id):
+    if id in people:
+        return people[id].get_dict()
+    else:
+        return None
+
 # ----------------------------------------------------------------------------
 class Family:
 
+    __slots__ = ('id', 'husband', 'wife', 'children')
+
     def __init__(self, id, husband, wife):
-        super().__init__()
         self.id = id
         self.husband = husband
         self.wife = wife
-        self.children = []
+        self.children = []      # person ids
 
     def add_child(self, id):
         self.children.append(id)
         
-    def get_dict(self):
+    def get_dict(self, expand=False):
         family_dict = {}
     
         family_dict["id"] = encode(self.id)
         family_dict["husband_id"] = encode(self.husband)
         family_dict["wife_id"] = encode(self.wife)
-        ids = []
-        for child in self.children:
-            ids.append(encode(child.id))
-        family_dict["children"] = ids
+        family_dict["children"] = [encode(child) for child in self.children]
+
+        # ?expand=people - include the person records of the whole family
+        if expand:
+            family_dict["people"] = {
+                "husband": get_person_dict(self.husband),
+                "wife": get_person_dict(self.wife),
+                "children": [get_person_dict(child) for child in self.children],
+            }
     
         return family_dict
 
@@ -205,44 +457,51 @@ class Family:
         output += f'husband    : {encode(self.husband)}\n'
         output += f'wife       : {encode(self.wife)}\n'
         for child in self.children:
-            output += f'  Child    : {encode(child.id)}\n'
+            output += f'  Child    : {encode(child)}\n'
 
         return output
 
 
 # ----------------------------------------------------------------------------
-def build_tree(gens):
+def build_tree(gens, seed=None):
+    # Families are created depth first with an explicit stack instead of
+    # recursion, so the number of generations isn't limited by the recursion
+    # limit.  Ids come out in the same order as the old recursive builder:
+    # a family, then all of the husband's ancestors, then the wife's.
+    # The tree is built in local dicts and published when it is complete, so
+    # a request served during /start never sees a half-built tree.
     global people
     global families
+    global person_json
+    global family_json
     global log
 
-    people = {}
-    families = {}
+    if seed != None:
+        random.seed(seed)
+
+    tree_people = {}
+    tree_families = {}
 
     next_person_id = 1
     next_family_id = 1
 
-    def _create_family(generation):
-        nonlocal next_person_id
-        nonlocal next_family_id
-        
-        # print(f'Generation: {generation}')
-        # print(f'next person / family: {next_person_id} / {next_family_id}')
-        if generation < 1:
-            return
+    # (generation, person whose parents this family is)
+    pending = [(gens, None)] if gens >= 1 else []
+    while pending:
+        generation, child_of = pending.pop()
 
         husband = Person(next_person_id, get_name_male())
-        people[next_person_id] = husband
+        tree_people[next_person_id] = husband
         next_person_id += 1
 
         wife = Person(next_person_id, get_name_female())
-        people[next_person_id] = wife
+        tree_people[next_person_id] = wife
         next_person_id += 1
 
         family = Family(next_family_id, husband.id, wife.id)
         husband.add_family(next_family_id)
         wife.add_family(next_family_id)
-        families[next_family_id] = family
+        tree_families[next_family_id] = family
         next_family_id += 1
 
         number_children = random.randint(2, 8)
@@ -253,197 +512,655 @@ def build_tree(gens):
             else:
                 child = Person(next_person_id, get_name_female())
 
-            people[next_person_id] = child
-            family.add_child(child)
+            tree_people[next_person_id] = child
+            family.add_child(child.id)
             next_person_id += 1
 
-        if generation > 1:
-            # create parents and recurve calls
-            husband_parents = _create_family(generation - 1)
-            husband.add_parents(husband_parents.id)
-            husband_parents.add_child(husband)
-
-            wife_parents = _create_family(generation - 1)
-            wife.add_parents(wife_parents.id)
-            wife_parents.add_child(wife)
+        if child_of != None:
+            child_of.add_parents(family.id)
+            family.add_child(child_of.id)
 
+        if generation > 1:
+            # wife is pushed first so the husband's parents are built first
+            pending.append((generation - 1, wife))
+            pending.append((generation - 1, husband))
 
-        # return the family that was created
-        return family
-
-    _create_family(gens)
+    # the records before the caches: a request that finds the new, empty
+    # cache also finds the new records and can't fill it with old ones
+    people = tree_people
+    families = tree_families
+    person_json = {}
+    family_json = {}
 
     print(f'Number of people  : {len(people)}')
     print(f'Number of families: {len(families)}')
     log.write(f'Number of people  : {len(people)}')
     log.write(f'Number of families: {len(families)}')
 
+
+def walk_pedigree(family_id, depth):
+    # Breadth first walk from a family up through the parents of the
+    # husband and wife.  depth < 1 walks every generation.
+    seen = set()
+    pending = deque([(family_id, 1)])
+    while pending:
+        id, generation = pending.popleft()
+        if id in seen or id not in families:
+            continue
+        seen.add(id)
+
+        family = families[id]
+        yield family
+
+        if depth < 1 or generation < depth:
+            for person_id in (family.husband, family.wife):
+                person = people.get(person_id)
+                if person != None and person.parents != None:
+                    pending.append((person.parents, generation + 1))
+
     
 # ----------------------------------------------------------------------------
-class Handler(BaseHTTPRequestHandler):
+# Request handling shared by the threaded and the asyncio servers
+
+def get_person_json(id):
+    # The cache is read before the records, once each.  build_tree() swaps
+    # the records first, so a reply being built while /start runs can put
+    # a record of the new tree into the old cache, never the other way round.
+    cache = person_json
+    data = cache.get(id)
+    if data == None:
+        person = people.get(id)
+        if person != None:
+            data = bytes(json.dumps(person.get_dict()), "utf8")
+            cache[id] = data
+    return data
+
+def get_family_json(id, expand=False):
+    cache = family_json
+    data = cache.get((id, expand))
+    if data == None:
+        family = families.get(id)
+        if family != None:
+            data = bytes(json.dumps(family.get_dict(expand)), "utf8")
+            cache[(id, expand)] = data
+    return data
+
+def expand_people(url):
+    return 'people' in parse_qs(url.query).get('expand', [])
+
+def start_request(path):
+    # returns the start time that finish_request() needs
+    global thread_count
+    global max_thread_count
+    global call_count
+
+    with lock:
+        thread_count += 1
+        call_count += 1
+        if thread_count > max_thread_count:
+            max_thread_count = thread_count
+        log.write(f'Current: active threads / max count: {thread_count} / {max_thread_count}', DEBUG, show=True)
+
+    log.write('- ' * 35, DEBUG, show=True)
+    log.write(f'Request: {path}', DEBUG, show=True)
+
+    return metrics.start()
+
+def finish_request(path, started, status, sent, arrival=None):
+    # arrival is when the request reached the server, before it waited for
+    # a thread; started is from start_request()
+    global thread_count
+    with lock:
+        thread_count -= 1
+    route = route_name(path)
+    metrics.finish(route, started, status, sent)
+
+    if trace != None:
+        finished = time.perf_counter()
+        record = {
+            'route': route,
+            'path': path,
+            'arrival': round((arrival or started) - trace_epoch, 6),
+            'start': round(started - trace_epoch, 6),
+            'finish': round(finished - trace_epoch, 6),
+            'thread': threading.get_ident(),
+            'status': status,
+            'bytes': sent,
+        }
+        trace.write(json.dumps(record, separators=(',', ':')))
+
+def get_metrics_json():
+    return bytes(json.dumps(metrics.get_dict()), "utf8")
+
+def get_pedigree_lines(url):
+    # /pedigree/{family_id}?depth=N - one expanded family per line (NDJSON)
+    # generated while walking the tree.  None if the family isn't found.
+    parts = url.path.split('/')
+    try:
+        id = decode(int(parts[2]))
+        depth = int(parse_qs(url.query).get('depth', ['0'])[0])
+    except (IndexError, ValueError):
+        id = None
+
+    if id not in families:
+        return None
+
+    def _lines():
+        for family in walk_pedigree(id, depth):
+            family_request_order.append(family.id)
+            yield get_family_json(family.id, True) + b'\n'
+
+    return _lines()
 
-    def get_person(self, id):
-        global people
-        if id in people:
-            return people[id].get_dict()
+def get_reply(url):
+    # JSON (bytes) to send back for a request, None for a 404
+    global max_thread_count
+    global thread_count
+    global call_count
+    global family_request_order
+    global generations_created
+
+    path = url.geturl()
+
+    if url.path in ('/people', '/families'):
+        # Batch request: one API call (and one SLEEP) for many records.
+        # Unknown ids are returned as null in the same position.
+        ids = decode_ids(url.query)
+        if ids == None:
+            return None
+        elif url.path == '/people':
+            return b'[' + b','.join(get_person_json(id) or b'null' for id in ids) + b']'
         else:
+            family_request_order.extend(ids)
+            expand = expand_people(url)
+            return b'[' + b','.join(get_family_json(id, expand) or b'null' for id in ids) + b']'
+
+    elif 'start' in path:
+        family_request_order = []
+        parts = url.path.split('/')
+        if len(parts) < 3:
             return None
 
+        try:
+            generations = int(parts[-1])
+        except:
+            generations = MAX_GENERATIONS
 
-    def get_family(self, id):
-        global families
-        if id in families:
-            return families[id].get_dict()
-        else:
+        # /start/{gens}?seed=N builds the same tree every time
+        try:
+            seed = int(parse_qs(url.query)['seed'][0])
+        except (KeyError, ValueError):
+            seed = tree_seed
+
+        output = f'Creating family tree with {generations} generations...'
+        print(output)
+        log.write(output)
+
+        generations_created = generations
+        build_tree(generations, seed)
+        metrics.reset()
+
+        max_thread_count = 1
+        thread_count = 1
+        call_count = 1
+
+        return b'{"status":"OK"}'
+
+    elif 'end' in path:
+        print('#' * 80)
+        log.write('#' * 80)
+
+        print(f'Total number of people  : {len(people)}')
+        print(f'Total number of families: {len(families)}')
+        print(f'Number of generations   : {generations_created}')
+        log.write(f'Total number of people  : {len(people)}')
+        log.write(f'Total number of families: {len(families)}')
+        log.write(f'Number of generations   : {generations_created}')
+
+
+        print('Families were requested in this order:')
+        log.write('Families were requested in this order:')
+        
+        output = str(family_request_order)[1:-1]
+        print(output)
+        log.write(output)
+
+        print(f'Total number of API calls: {call_count}')
+        log.write(f'Total number of API calls: {call_count}')
+
+        print(f'Final thread count (max count): {max_thread_count}')
+        log.write(f'Final thread count (max count): {max_thread_count}')
+
+        data_str = '{' + \
+                   f'"status":"OK", "people": {len(people)}, "families": {len(families)}, "api": {call_count}, "threads": {max_thread_count}' + \
+                   '}'
+        json_data = bytes(json.dumps(ast.literal_eval(data_str)), "utf8")
+
+        print('#' * 80)
+        log.write('#' * 80)
+
+        return json_data
+
+    elif 'person' in path or 'family' in path:
+        parts = url.path.split('/')
+        # print('****************************')
+        # print(parts)
+
+        if len(parts) < 3:
+            return None
+
+        try:
+            id = decode(int(parts[-1]))
+        except:
+            id = None
+
+        if id == None:
             return None
+
+        if 'person' in path:
+            return get_person_json(id)
+        else:
+            family_request_order.append(id)
+            return get_family_json(id, expand_people(url))
+    else:
+        start_id = 1 # random.randint(1, 100000)
+        data = {"start_family_id" : encode(start_id)}
+        return bytes(json.dumps(data), "utf8")
+
+
+# ----------------------------------------------------------------------------
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1' if KEEP_ALIVE else 'HTTP/1.0'
+    timeout = KEEP_ALIVE_TIMEOUT if KEEP_ALIVE else None
+    # headers and body are separate writes: without TCP_NODELAY the body
+    # waits for the client's delayed ACK, about 40 ms on every keep-alive reply
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        # With a pool that parks idle connections, handle the requests that
+        # have already arrived and give the thread back.  The server waits
+        # for the next request on the connection without holding a thread.
+        keep_open = getattr(self.server, 'keep_open', None)
+        if keep_open == None:
+            super().handle()
+            return
+
+        self.handle_one_request()
+        while not self.close_connection and self.request_waiting():
+            self.handle_one_request()
+        if not self.close_connection:
+            keep_open()
+
+    def request_waiting(self):
+        # True if the next request is already buffered or on the socket
+        self.connection.settimeout(0)
+        try:
+            return len(self.rfile.peek(1)) > 0
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def parse_request(self):
+        # a request arrived when its connection was queued for a pool
+        # thread, requests read right after it arrive as they are read
+        take_arrival = getattr(self.server, 'take_arrival', None)
+        self.arrival = (take_arrival and take_arrival()) or time.perf_counter()
+        return super().parse_request()
+
+    def log_message(self, format, *args):
+        # access log lines go through the buffered log instead of stderr
+        log.write(f'{self.address_string()} - {format % args}', DEBUG)
+
+    def send_json(self, code, json_data=None):
+        # Content-Length is required for the client to find the end of the
+        # reply on a persistent connection
+        body = b'' if json_data == None else json_data
+        self.status_code = code
+        self.bytes_sent += len(body)
+        self.send_response(code)
+        self.send_header("Content-type",  "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def send_pedigree(self, url):
+        lines = get_pedigree_lines(url)
+        if lines == None:
+            self.send_json(404)
+            return
+
+        # The length isn't known up front: use chunked encoding for HTTP/1.1
+        # clients, otherwise the end of the stream is the connection closing
+        chunked = self.protocol_version == 'HTTP/1.1' and self.request_version == 'HTTP/1.1'
+        if not chunked:
+            self.close_connection = True
+
+        self.status_code = 200
+        self.send_response(200)
+        self.send_header("Content-type",  "application/x-ndjson")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        count = 0
+        try:
+            for line in lines:
+                if chunked:
+                    self.wfile.write(b'%X\r\n%s\r\n' % (len(line), line))
+                else:
+                    self.wfile.write(line)
+                self.bytes_sent += len(line)
+                count += 1
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+            log.write(f'Pedigree stream closed by client after {count} families', DEBUG, show=True)
+            return
+
+        log.write(f'Streamed {count} families', DEBUG, show=True)
  
     def do_GET(self):
-        global thread_count
-        global lock
-        global max_thread_count
-        global call_count
-        global family_request_order
-        global log
-        global generations_created
-
-        with lock:
-            thread_count += 1
-            call_count += 1
-            if thread_count > max_thread_count:
-                max_thread_count = thread_count
-            print(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
-            log.write(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
-
-        print('- ' * 35)
-        print(f'Request: {self.path}')
-
-        log.write(f'Request: {self.path}')
+        self.status_code = None
+        self.bytes_sent = 0
 
-        if SLEEP > 0:
-            time.sleep(SLEEP)
-
-        if 'start' in self.path:
-            family_request_order = []
-            parts = self.path.split('/')
-            if len(parts) < 3:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+        if urlparse(self.path).path == '/metrics':
+            # can be read at any time: no SLEEP and not counted as an API call
+            self.send_json(200, get_metrics_json())
+            return
 
-            try:
-                generations = int(parts[-1])
-            except:
-                generations = MAX_GENERATIONS
-
-            output = f'Creating family tree with {generations} generations...'
-            print(output)
-            log.write(output)
-
-            generations_created = generations
-            build_tree(generations)
-
-            max_thread_count = 1
-            thread_count = 1
-            call_count = 1
-
-            json_data = '{"status":"OK"}'
-
-                    
-        elif 'end' in self.path:
-            print('#' * 80)
-            log.write('#' * 80)
-
-            print(f'Total number of people  : {len(people)}')
-            print(f'Total number of families: {len(families)}')
-            print(f'Number of generations   : {generations_created}')
-            log.write(f'Total number of people  : {len(people)}')
-            log.write(f'Total number of families: {len(families)}')
-            log.write(f'Number of generations   : {generations_created}')
-
-
-            print('Families were requested in this order:')
-            log.write('Families were requested in this order:')
-            
-            output = str(family_request_order)[1:-1]
-            print(output)
-            log.write(output)
-
-            print(f'Total number of API calls: {call_count}')
-            log.write(f'Total number of API calls: {call_count}')
-
-            print(f'Final thread count (max count): {max_thread_count}')
-            log.write(f'Final thread count (max count): {max_thread_count}')
-
-            data_str = '{' + \
-                       f'"status":"OK", "people": {len(people)}, "families": {len(families)}, "api": {call_count}, "threads": {max_thread_count}' + \
-                       '}'
-            json_data = json.dumps(ast.literal_eval(data_str))
-
-            print('#' * 80)
-            log.write('#' * 80)
-
-        elif 'person' in self.path or 'family' in self.path:
-            parts = self.path.split('/')
-            # print('****************************')
-            # print(parts)
-
-            if len(parts) < 3:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+        started = start_request(self.path)
+        try:
+            if SLEEP > 0:
+                time.sleep(SLEEP)
 
-            try:
-                id = decode(int(parts[-1]))
-            except:
-                id = None
-
-            if id == None:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
+            url = urlparse(self.path)
+            if url.path.startswith('/pedigree/'):
+                self.send_pedigree(url)
                 return
 
-            if 'person' in self.path:
-                data = self.get_person(id)
+            json_data = get_reply(url)
+            if json_data == None:
+                self.send_json(404)
             else:
-                data = self.get_family(id)
-                family_request_order.append(id)
+                log.write_payload('Sending', json_data, show=True)
+
+                self.send_json(200, json_data)
+        finally:
+            finish_request(self.path, started, self.status_code, self.bytes_sent, self.arrival)
+
+class ThreadPoolServer(HTTPServer):
+    """ HTTP server that handles connections with a fixed pool of threads.
+        Accepted connections wait in a bounded queue.  When the queue is full
+        the client is sent a 503 "busy" reply instead, and a separate thread
+        reads the request and closes the connection.  Between requests an
+        idle keep-alive connection is parked in a selector, not in a pool
+        thread, and queued again when its next request arrives. """
+
+    def __init__(self, server_address, handler, workers=POOL_WORKERS, backlog=POOL_BACKLOG):
+        self.request_queue_size = backlog
+        self.connections = queue.Queue(maxsize=backlog)
+        self.workers = []
+        self.local = threading.local()
+        self.rejected = queue.SimpleQueue()
+        self.parked = queue.SimpleQueue()
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_writer.setblocking(False)
+        super().__init__(server_address, handler)
+        for _ in range(workers):
+            t = threading.Thread(target=self.worker, daemon=True)
+            t.start()
+            self.workers.append(t)
+        threading.Thread(target=self.rejecter, daemon=True).start()
+        threading.Thread(target=self.parker, daemon=True).start()
+
+    def worker(self):
+        while True:
+            item = self.connections.get()
+            if item is None:
+                break
+            request, client_address, self.local.arrival = item
+            self.local.keep = False
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.local.keep = False
+                self.handle_error(request, client_address)
+            finally:
+                if self.local.keep:
+                    self.park(request, client_address)
+                else:
+                    self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        try:
+            self.connections.put_nowait((request, client_address, time.perf_counter()))
+        except queue.Full:
+            self.send_busy(request)
+
+    def keep_open(self):
+        # called by the handler: park the connection instead of closing it
+        self.local.keep = True
+
+    def park(self, request, client_address):
+        self.parked.put((request, client_address))
+        self.wake()
+
+    def wake(self):
+        try:
+            self.wake_writer.send(b'x')
+        except BlockingIOError:
+            pass    # the buffer is full, the parker will wake up anyway
+
+    def parker(self):
+        # Waits for the next request on parked connections.  A readable one
+        # goes back in the queue for a pool thread, one that was closed by
+        # the client or stayed idle KEEP_ALIVE_TIMEOUT seconds is closed.
+        selector = selectors.DefaultSelector()
+        selector.register(self.wake_reader, selectors.EVENT_READ)
+        idle = {}
+        running = True
+        while running:
+            while True:
+                try:
+                    item = self.parked.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                request, client_address = item
+                selector.register(request, selectors.EVENT_READ, client_address)
+                idle[request] = time.perf_counter()
+            if not running:
+                break
+
+            for key, _ in selector.select(timeout=1):
+                if key.fileobj is self.wake_reader:
+                    self.wake_reader.recv(4096)
+                    continue
+                request = key.fileobj
+                selector.unregister(request)
+                del idle[request]
+                try:
+                    closed = request.recv(1, socket.MSG_PEEK) == b''
+                except OSError:
+                    closed = True
+                if closed:
+                    self.shutdown_request(request)
+                else:
+                    self.process_request(request, key.data)
+
+            expired = time.perf_counter() - KEEP_ALIVE_TIMEOUT
+            for request in [request for request, since in idle.items() if since < expired]:
+                selector.unregister(request)
+                del idle[request]
+                self.shutdown_request(request)
+
+        for request in idle:
+            self.shutdown_request(request)
+        selector.close()
+        self.wake_reader.close()
+        self.wake_writer.close()
+
+    def take_arrival(self):
+        # when the connection this thread is handling was queued, only once
+        arrival = self.local.arrival
+        self.local.arrival = None
+        return arrival
+
+    def send_busy(self, request):
+        body = b'{"status":"BUSY"}'
+        reply = b'HTTP/1.0 503 Service Unavailable\r\n' + \
+                b'Content-type: application/json\r\n' + \
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\n' + \
+                b'Retry-After: 1\r\n' + \
+                b'Connection: close\r\n\r\n' + body
+        try:
+            # called from the accept loop: never wait on the client here, the
+            # reply fits in the empty send buffer of a new connection
+            request.setblocking(False)
+            request.send(reply)
+        except OSError:
+            pass
+        self.rejected.put(request)
+
+    def rejecter(self):
+        # Reads the request of each rejected connection before closing it:
+        # closing a socket with unread data resets the connection and the
+        # client may never see the 503
+        while True:
+            request = self.rejected.get()
+            if request is None:
+                break
+            try:
+                request.settimeout(0.1)
+                request.recv(65536)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self.workers:
+            self.connections.put(None)
+        self.rejected.put(None)
+        self.parked.put(None)
+        self.wake()
 
-            if data != None:
-                json_data = json.dumps(data)
+# ----------------------------------------------------------------------------
+# asyncio server: the same API, but a request waiting on SLEEP is a paused
+# coroutine instead of a blocked thread.  thread_count / max_thread_count
+# then count requests in flight.
+
+def http_head(code, content_type, keep_alive, length=None, chunked=False):
+    # without a length or chunked encoding the reply ends when the
+    # connection is closed, keep_alive must be False then
+    head = f'HTTP/1.1 {code} {HTTPStatus(code).phrase}\r\n'
+    head += f'Content-type: {content_type}\r\n'
+    if length != None:
+        head += f'Content-Length: {length}\r\n'
+    elif chunked:
+        head += 'Transfer-Encoding: chunked\r\n'
+    head += f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+    return bytes(head, 'latin-1')
+
+async def handle_async_request(path, writer, keep_alive, arrival=None, version='HTTP/1.1'):
+    # returns whether the connection can be kept open after this reply
+    url = urlparse(path)
+    if url.path == '/metrics':
+        json_data = get_metrics_json()
+        writer.write(http_head(200, 'application/json', keep_alive, len(json_data)) + json_data)
+        await writer.drain()
+        return keep_alive
+
+    status = 404
+    sent = 0
+    started = start_request(path)
+    try:
+        if SLEEP > 0:
+            await asyncio.sleep(SLEEP)
+
+        if url.path.startswith('/pedigree/'):
+            lines = get_pedigree_lines(url)
+            if lines == None:
+                writer.write(http_head(404, 'application/json', keep_alive, 0))
             else:
-                json_data = None
-        else:
-            start_id = 1 # random.randint(1, 100000)
-            data = {"start_family_id" : encode(start_id)}
-            json_data = json.dumps(data)
-
-        if json_data == None:
-            self.send_response(404)
-            self.send_header("Content-type",  "application/json")
-            self.end_headers()
+                # chunked encoding for HTTP/1.1 clients, otherwise the end of
+                # the stream is the connection closing
+                chunked = version == 'HTTP/1.1'
+                if not chunked:
+                    keep_alive = False
+                status = 200
+                writer.write(http_head(200, 'application/x-ndjson', keep_alive, chunked=chunked))
+                for line in lines:
+                    writer.write(b'%X\r\n%s\r\n' % (len(line), line) if chunked else line)
+                    sent += len(line)
+                    await writer.drain()
+                if chunked:
+                    writer.write(b'0\r\n\r\n')
         else:
-            print('Sending:', json_data)
-            log.write(f'Sending: {json_data}')
+            json_data = get_reply(url)
+            if json_data == None:
+                writer.write(http_head(404, 'application/json', keep_alive, 0))
+            else:
+                log.write_payload('Sending', json_data, show=True)
+
+                status = 200
+                sent = len(json_data)
+                writer.write(http_head(200, 'application/json', keep_alive, len(json_data)) + json_data)
+        await writer.drain()
+    finally:
+        finish_request(path, started, status, sent, arrival)
+    return keep_alive
+
+async def handle_connection(reader, writer):
+    try:
+        while True:
+            try:
+                request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+            except asyncio.TimeoutError:
+                break
+            if not request_line:
+                break
+            arrival = time.perf_counter()
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip().lower()
+
+            parts = request_line.decode('latin-1').split()
+            if len(parts) != 3 or parts[0] != 'GET':
+                writer.write(http_head(400, 'application/json', False, 0))
+                await writer.drain()
+                break
+
+            method, path, version = parts
+            if version == 'HTTP/1.1':
+                keep_alive = KEEP_ALIVE and headers.get('connection') != 'close'
+            else:
+                keep_alive = KEEP_ALIVE and headers.get('connection') == 'keep-alive'
 
-            self.send_response(200)
-            self.send_header("Content-type",  "application/json")
-            self.end_headers()
-            self.wfile.write(bytes(json_data, "utf8"))
+            keep_alive = await handle_async_request(path, writer, keep_alive, arrival, version)
+            if not keep_alive:
+                break
+    except (ConnectionResetError, BrokenPipeError):
+        pass
+    finally:
+        writer.close()
 
-        with lock:
-            thread_count -= 1
+async def serve_async():
+    server = await asyncio.start_server(handle_connection, hostName, serverPort, backlog=POOL_BACKLOG)
+    async with server:
+        await server.serve_forever()
 
-class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    pass
 
 if __name__ == '__main__':
     # random.seed(101)
@@ -454,7 +1171,21 @@ if __name__ == '__main__':
     # for id in families:
     #     print(families[id])
 
-    server = ThreadingSimpleServer((hostName, serverPort), Handler)
-    print('Starting server, use <Ctrl-C> or <Command-C> to stop')
-    server.serve_forever()
+    args = sys.argv[1:]
+    if '--trace' in args:
+        index = args.index('--trace') + 1
+        filename = args[index] if index < len(args) and not args[index].startswith('--') else TRACE_FILE
+        open_trace(filename)
+        print(f'Writing request trace to {filename}')
+
+    if '--seed' in args:
+        seed_ids(int(args[args.index('--seed') + 1]))
+
+    if '--async' in args:
+        print('Starting asyncio server, use <Ctrl-C> or <Command-C> to stop')
+        asyncio.run(serve_async())
+    else:
+        server = ThreadPoolServer((hostName, serverPort), Handler)
+        print('Starting server, use <Ctrl-C> or <Command-C> to stop')
+        server.serve_forever()
 